@@ -13,10 +13,25 @@ this event complete, SD_reflow_done is sent to indicate that subsequent
 actions using the data can complete. For instance, a plot could do a final
 draw, since all artists should have received their updated data at this stage.
 
+SD_replay_reflow_start
+Sent in place of SD_reflow_start when LinkedPanels shows a view again from its
+ViewHistory, to reflow only the datasets that the history doesn't cover (see
+ViewHistory.reflow_on_replay).
+
+SD_remote_bounds_updated
+Bounds have changed in another process, and were relayed by 
+stormdrain.relay.ExchangeRelay.
+
+Subscribers to each exchange receive events in order of priority (see 
+stormdrain.pubsub): datasets (PRIORITY_DATA) before color limit updaters
+(PRIORITY_STYLE), and both before figure draws (PRIORITY_DRAW).
+
 """
 
 SD_exchanges = {
     'SD_bounds_updated':"Bounds instance has been updated",
     'SD_reflow_start':"Global data reflow, often follows bounds change",
     'SD_reflow_done':"Signals that data reflow is complete; should follows SD_reflow_start",
+    'SD_replay_reflow_start':"Reflow of the datasets not covered by a replayed view",
+    'SD_remote_bounds_updated':"Bounds instance received from another process",
     }
\ No newline at end of file
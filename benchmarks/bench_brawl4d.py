@@ -0,0 +1,348 @@
+""" Headless benchmark of the brawl4d pipeline in examples/brawl4d.py.
+
+    For each dataset size, a synthetic LMA-like dataset is plotted on two
+    Panels4D figures (lat/lon/alt/time, and projected with a
+    CoordinateSystemController), with the Agg backend. Then pans, zooms,
+    lassos and animation frames are scripted, and the time and peak memory
+    of each stage are reported as JSON.
+
+    Peak memory is the peak resident set size of the process during the
+    stage (--memory rss, on Linux), or the peak of the allocations traced by
+    tracemalloc since the stage started (--memory tracemalloc), which slows
+    drawing by an order of magnitude and so inflates the times.
+
+    python benchmarks/bench_brawl4d.py --sizes 1e4 1e5 1e6 --output run.json
+    python benchmarks/bench_brawl4d.py --baseline run.json
+
+    With --baseline, each stage is compared to the same stage and size in
+    an earlier output, and the exit status is 1 if any is slower (or uses
+    more memory) by more than --tolerance (or --memory-tolerance).
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples'))
+from brawl4d import Panels4D
+
+from stormdrain.bounds import BoundsFilter, FieldStatistics
+from stormdrain.data import NamedArrayDataset
+from stormdrain.pipeline import Branchpoint, ItemModifier, register
+from stormdrain.pubsub import get_exchange, exchanges, recording_metrics
+from stormdrain.support.coords.filters import CoordinateSystemController
+from stormdrain.support.matplotlib.animation import PipelineAnimation
+from stormdrain.support.matplotlib.artistupdaters import PanelsScatterController, FigureUpdater
+from stormdrain.support.matplotlib.poly_lasso import LassoPayloadController
+
+
+ctr_lat, ctr_lon = 33.5, -101.5
+duration = 600.0 # seconds of data
+
+lma_dtype = [('time', 'f8'), ('lat', 'f4'), ('lon', 'f4'), ('alt', 'f4'), ('chi2', 'f4'),
+             ('power', 'f4'), ('stations', 'u1'), ('charge', 'i1'), ('point_id', 'i8')]
+
+
+def lma_dataset(n, seed=0, points_per_flash=200, chunk=1000000):
+    """ n sources, clustered in flashes, in time order as in an LMA file """
+    rng = np.random.RandomState(seed)
+    data = np.empty(n, dtype=lma_dtype)
+    n_chunks = max(1, -(-n // chunk))
+    for i, start in enumerate(range(0, n, chunk)):
+        m = min(chunk, n - start)
+        n_flashes = max(1, m // points_per_flash)
+        t0 = np.sort(rng.uniform(i, i+1, n_flashes))*(duration/n_chunks)
+        flash = np.sort(rng.randint(0, n_flashes, m))
+        a = data[start:start+m]
+        a['time'] = t0[flash] + rng.exponential(0.2, m)
+        a['lat'] = (ctr_lat + rng.normal(0, 0.6, n_flashes))[flash] + rng.normal(0, 0.05, m)
+        a['lon'] = (ctr_lon + rng.normal(0, 0.6, n_flashes))[flash] + rng.normal(0, 0.05, m)
+        alt = rng.uniform(3e3, 12e3, n_flashes)[flash] + rng.normal(0, 1.5e3, m)
+        a['alt'] = np.clip(alt, 0, 20e3)
+        a['chi2'] = rng.exponential(1.0, m)
+        a['power'] = rng.normal(15, 8, m)
+        a['stations'] = rng.randint(6, 15, m)
+    data['charge'] = 0
+    data['point_id'] = np.arange(n)
+    return data
+
+
+class LassoChargeController(LassoPayloadController):
+    charge = LassoPayloadController.Payload()
+
+
+class Brawl4D(object):
+    """ The figures and pipeline of examples/brawl4d.py, plus a lasso that
+        sets the charge of the points it selects on the lat/lon panel.
+    """
+    def __init__(self, data):
+        self.figure = plt.figure(figsize=(8, 10))
+        self.panels = Panels4D(figure=self.figure)
+        self.fig_updater = FigureUpdater(self.figure)
+        self.dataset = NamedArrayDataset(data, selections=True)
+        with self.panels.transaction():
+            self.scatter_ctrl = PanelsScatterController(panels=self.panels, color_field='time')
+            stats = FieldStatistics(data, fields=('lat', 'lon', 'alt', 'time'))
+            pipe = register([(BoundsFilter, 'filter', {'bounds':self.panels.bounds, 'statistics':stats}),
+                             (Branchpoint, 'broadcast', {}),
+                            ], target=self.scatter_ctrl.branchpoint.broadcast())
+            self.branch = pipe.find(Branchpoint)
+            self.dataset.target = pipe.inlet
+            self.panels.set_limits(**full_view)
+
+        self.figure2 = plt.figure(figsize=(8, 10))
+        self.panels2 = Panels4D(figure=self.figure2, names_4D=('x', 'y', 'z', 'time'))
+        self.fig_updater2 = FigureUpdater(self.figure2)
+        with self.panels2.transaction():
+            self.scatter_ctrl2 = PanelsScatterController(panels=self.panels2, color_field='time')
+            cs = CoordinateSystemController(ctr_lat, ctr_lon, 0.0)
+            self.branch.targets.add(cs.project_points(target=self.scatter_ctrl2.branchpoint.broadcast(),
+                        x_coord='x', y_coord='y', z_coord='z', lat_coord='lat', lon_coord='lon',
+                        alt_coord='alt', distance_scale_factor=1.0e-3))
+            self.panels2.set_limits(x=(-200, 200), y=(-200, 200), time=(0, duration), z=(0, 20))
+
+        charge_modifier = ItemModifier(target=self.dataset.update(field_names=['charge']),
+                                       item_name='charge')
+        self.lasso = LassoChargeController(target=charge_modifier.modify(), cache_base=self.dataset)
+        self.branch.targets.add(self.lasso.cache_segment.cache_segment())
+
+    def close(self):
+        plt.close(self.figure)
+        plt.close(self.figure2)
+
+
+full_view = {'lon':(ctr_lon-1.5, ctr_lon+1.5), 'lat':(ctr_lat-1.5, ctr_lat+1.5),
+             'alt':(0, 20e3), 'time':(0, duration)}
+
+
+def pan(app, steps=8):
+    for i in range(steps):
+        dx, dy = 0.25*np.cos(i*np.pi/4), 0.25*np.sin(i*np.pi/4)
+        app.panels.set_limits(lon=(ctr_lon-0.5+dx, ctr_lon+0.5+dx), lat=(ctr_lat-0.5+dy, ctr_lat+0.5+dy))
+    return steps
+
+def zoom(app, steps=8):
+    for i in range(steps):
+        zoom_level = i % (steps//2) + 1
+        scale = 1.5*0.6**zoom_level
+        t_mid, t_half = 0.5*duration, 0.5*duration*0.6**zoom_level
+        with app.panels.transaction():
+            app.panels.set_limits(lon=(ctr_lon-scale, ctr_lon+scale), lat=(ctr_lat-scale, ctr_lat+scale))
+            app.panels.set_limits(time=(t_mid-t_half, t_mid+t_half))
+    app.panels.set_limits(**full_view)
+    return steps + 1
+
+def lasso(app, steps=4):
+    lasso_xchg = get_exchange('B4D_panel_lasso_drawn')
+    ax = app.panels.panels['xy']
+    angles = np.linspace(0, 2*np.pi, 24, endpoint=False)
+    for i in range(steps):
+        radius = 0.3*(1.0 + 0.3*np.sin(5*angles + i))
+        verts = list(zip(ctr_lon + radius*np.cos(angles), ctr_lat + radius*np.sin(angles)))
+        app.lasso.charge = 1 if (i % 2) else -1
+        lasso_xchg.send((app.panels, ax, None, verts))
+        # Redraw with the new charges
+        app.panels.bounds_updated()
+    return steps
+
+def animation(app, frames=20):
+    anim = PipelineAnimation(frames, app.scatter_ctrl.artist_outlets, variable='time',
+                             limits=app.panels.bounds.time,
+                             branchpoint_data_source=app.scatter_ctrl.branchpoint)
+    get_exchange('SD_reflow_start').send("Pre-animation data reflow")
+    for frame in range(frames):
+        anim.draw_frame(None, (frame + 1.0)/frames)
+        app.figure.canvas.draw()
+    anim.cleanup(None)
+    return frames
+
+interactions = (('pan', pan), ('zoom', zoom), ('lasso', lasso), ('animation', animation))
+
+
+def _status_bytes(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])*1024
+
+def _reset_peak_rss():
+    # Linux resets the VmHWM high water mark
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+def memory_modes():
+    modes = ['none']
+    if tracemalloc is not None:
+        modes.insert(0, 'tracemalloc')
+    try:
+        _reset_peak_rss()
+        if _status_bytes('VmHWM') is not None:
+            modes.insert(0, 'rss')
+    except (IOError, OSError):
+        pass
+    return modes
+
+@contextmanager
+def measure(result, memory='rss'):
+    """ Fill result with the seconds, peak_bytes, and reflows of the block """
+    if memory == 'tracemalloc':
+        tracemalloc.start()
+    elif memory == 'rss':
+        _reset_peak_rss()
+    with recording_metrics() as metrics:
+        t0 = time.time()
+        yield result
+        result['seconds'] = time.time() - t0
+    result['reflows'] = metrics.get('SD_reflow_start', {}).get('messages', 0)
+    result['peak_bytes'] = None
+    if memory == 'tracemalloc':
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    elif memory == 'rss':
+        result['peak_bytes'] = _status_bytes('VmHWM')
+
+def _subscribers():
+    return dict((x['name'], set(id(task) for task in get_exchange(x['name']).subscribers))
+                for x in exchanges())
+
+def _detach_new(before):
+    # Exchanges are global, so subscribers for one size would keep drawing
+    # its figures during the next.
+    for x in exchanges():
+        xchg = get_exchange(x['name'])
+        for task in xchg.subscribers:
+            if id(task) not in before.get(x['name'], ()):
+                xchg.detach(task)
+
+def _finished(stages, name, result):
+    result['per_op'] = result['seconds']/result['ops']
+    stages[name] = result
+    print('  {0:10s} {1:9.4f} s/op  {2:6d} reflows  peak {3}'.format(name, result['per_op'],
+          result['reflows'], result['peak_bytes']), file=sys.stderr)
+
+def run_size(n, repeat=3, memory='rss', seed=0):
+    stages = {}
+    before = _subscribers()
+    with measure({'ops':1}, memory) as result:
+        data = lma_dataset(n, seed=seed)
+    _finished(stages, 'build', result)
+    with measure({'ops':1}, memory) as result:
+        app = Brawl4D(data)
+    _finished(stages, 'setup', result)
+    try:
+        with measure({'ops':2}, memory) as result:
+            app.figure.canvas.draw()
+            app.figure2.canvas.draw()
+        _finished(stages, 'draw', result)
+        for name, interaction in interactions:
+            trials = []
+            for i in range(repeat):
+                with measure({}, memory) as trial:
+                    trial['ops'] = interaction(app)
+                trials.append(trial)
+            best = min(trials, key=lambda trial: trial['seconds'])
+            best['trials'] = [trial['seconds'] for trial in trials]
+            _finished(stages, name, best)
+    finally:
+        app.close()
+        _detach_new(before)
+    return stages
+
+
+def compare(results, baseline, tolerance=0.2, memory_tolerance=0.2):
+    """ List of {'size', 'stage', 'metric', 'ratio', 'regressed'} for each stage
+        in results and baseline. Memory isn't compared if memory_tolerance is None.
+    """
+    comparisons = []
+    for size, stages in sorted(results.items(), key=lambda item: int(item[0])):
+        for stage, result in sorted(stages.items()):
+            base = baseline.get(size, {}).get(stage)
+            if base is None:
+                continue
+            for metric, limit in (('per_op', tolerance), ('peak_bytes', memory_tolerance)):
+                if (limit is None) or not (result.get(metric) and base.get(metric)):
+                    continue
+                ratio = float(result[metric])/base[metric]
+                comparisons.append({'size':size, 'stage':stage, 'metric':metric, 'ratio':ratio,
+                                    'regressed':ratio > 1.0 + limit})
+    return comparisons
+
+def environment():
+    env = {'python':platform.python_version(), 'platform':platform.platform(),
+           'numpy':np.__version__, 'matplotlib':matplotlib.__version__,
+           'time':time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+        import numba
+        env['numba'] = numba.__version__
+    except ImportError:
+        env['numba'] = None
+    return env
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e4, 1e5, 1e6],
+                        help='numbers of LMA sources, from 1e4 to 1e8')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='trials of each interaction; the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    modes = memory_modes()
+    parser.add_argument('--memory', choices=modes, default=modes[0],
+                        help='how peak memory is measured')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fractional slowdown of a stage that counts as a regression')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2,
+                        help='fractional increase in peak memory that counts as a regression')
+    args = parser.parse_args(argv)
+
+    report = {'environment':environment(), 'arguments':vars(args), 'results':{}}
+    for size in args.sizes:
+        n = int(size)
+        print('{0} sources'.format(n), file=sys.stderr)
+        stages = run_size(n, repeat=args.repeat, memory=args.memory, seed=args.seed)
+        report['results'][str(n)] = stages
+
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        memory_tolerance = args.memory_tolerance
+        if baseline['arguments'].get('memory') != args.memory:
+            # peak_bytes aren't comparable
+            memory_tolerance = None
+        report['comparison'] = compare(report['results'], baseline['results'],
+                                       args.tolerance, memory_tolerance)
+        for c in report['comparison']:
+            if c['regressed']:
+                regressed = True
+                print('REGRESSION {size} {stage} {metric}: {ratio:.2f}x baseline'.format(**c),
+                      file=sys.stderr)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,66 @@
+from contextlib import contextmanager
+import threading
+import weakref
+
 import numpy as np
 
+from stormdrain.cache import ByteBudgetCache
 from stormdrain.pipeline import Segment, coroutine
-        
+from stormdrain.kernels import range_mask
+from stormdrain.selection import Selection, select
+
+
+class FieldStatistics(object):
+    """ Quantiles of each field of array a, from which the fraction of the
+        records within a range of a field can be estimated cheaply. Collect
+        these once, when the data are loaded.
+    """
+
+    def __init__(self, a, fields=None, n_quantiles=33):
+        if fields is None:
+            fields = a.dtype.names
+        self.fractions = np.linspace(0.0, 1.0, n_quantiles)
+        self.quantiles = {}
+        for k in fields:
+            values = np.asarray(a[k])
+            if (values.dtype.kind not in 'iuf') or (values.size == 0):
+                continue
+            values = values[np.isfinite(values)]
+            if values.size > 0:
+                self.quantiles[k] = np.percentile(values, 100.0*self.fractions)
+
+    def selectivity(self, k, v_min, v_max):
+        """ Estimated fraction of records with v_min <= k <= v_max, or 1.0 if
+            there are no statistics for k.
+        """
+        q = self.quantiles.get(k)
+        if q is None:
+            return 1.0
+        lo, hi = np.interp((v_min, v_max), q, self.fractions)
+        return max(hi - lo, 0.0)
+
+
+def _field_at(a, k, index):
+    if isinstance(a, Selection):
+        return a.select(index)[k]
+    return a[k][index]
+
+
+def _source_key(a):
+    """ Identifies data for which results computed earlier can be reused """
+    if (getattr(a, 'version', None) is None) or not hasattr(a, 'base'):
+        return None
+    return (a.base, a.version, a.index)
+
+def _same_source(key, last):
+    if (key is None) or (last is None):
+        return False
+    if (key[0] is not last[0]) or (key[1] != last[1]):
+        return False
+    if isinstance(key[2], slice):
+        return key[2] == last[2]
+    return key[2] is last[2]
+
 
 class BoundsFilter(Segment):
     """ Filter showing use of the axes bounds to filter data from an array.
@@ -15,8 +74,8 @@ class BoundsFilter(Segment):
         The mechanics of how one breaks the pipeline and reconnects with a 
         modified filter are yet to be worked out - 
 
-        There is another version of this class, to be written, that filters across
-        all coordinates based on the bounds for all the axes.
+        There is another version of this class, PanelsBoundsFilter, that filters
+        each panel of a set of linked axes on the coordinates of that panel.
         
         Could filter on 
             1. all limits in bounds (restrict_to == None, the default)
@@ -29,17 +88,85 @@ class BoundsFilter(Segment):
             array "a" that is passed in, and the function should transform from bounds to limits
             on "a"
 
+        If statistics (an instance of FieldStatistics) are given, the range
+        tests are done in order of increasing estimated selectivity, the first
+        test on the whole array and the rest only on the records that passed
+        the previous tests.
+
     """
     
     def __init__(self, *args, **kwargs):
         bounds = kwargs.pop('bounds', None)
         restrict_to = kwargs.pop('restrict_to', None)
         transform_mapping = kwargs.pop('transform_mapping', {})
+        statistics = kwargs.pop('statistics', None)
         super(BoundsFilter, self).__init__(*args, **kwargs)
+        self.statistics = statistics
         self.bounds = bounds
         self.restrict_to = restrict_to
         self.transform_mapping = transform_mapping
         
+    def bounded_predicates(self, a, bounds=None):
+        """ Return a list of (bounds_name, name, v_min, v_max) range tests to 
+            apply to the fields of array a, after applying restrict_to and 
+            transform_mapping to the limits of bounds_name in bounds (by 
+            default, self.bounds).
+        """
+        if bounds is None:
+            bounds = self.bounds
+        preds = []
+        for bounds_k, (v_min, v_max) in bounds.limits():
+            k = bounds_k
+            if self.restrict_to is not None:
+                if not(k in self.restrict_to):
+                    continue
+            if k in self.transform_mapping:
+                new_k, transform_func = self.transform_mapping[k]
+                v_min, v_max = transform_func((v_min, v_max))
+                k = new_k
+            if k not in a.dtype.names:
+                # ensure that this array even has data of bounds_type=k
+                # implicitly ignores this bound, instead of returning empty
+                continue
+            preds.append((bounds_k, k, v_min, v_max))
+        return preds
+
+    def predicates(self, a, bounds=None):
+        """ Return a list of (name, v_min, v_max) range tests to apply to
+            the fields of array a, after applying restrict_to and 
+            transform_mapping to the limits in bounds (by default, self.bounds).
+        """
+        return [(k, v_min, v_max) for bounds_k, k, v_min, v_max in self.bounded_predicates(a, bounds)]
+
+    def ordered_predicates(self, a, bounds=None):
+        """ predicates(a), most selective first if there are statistics """
+        preds = self.predicates(a, bounds)
+        if self.statistics is not None:
+            preds.sort(key=lambda p: self.statistics.selectivity(*p))
+        return preds
+
+    def filter_index(self, a, bounds=None):
+        """ Integer index of the entries in a that are within bounds """
+        preds = self.ordered_predicates(a, bounds)
+        if not preds:
+            return np.arange(len(a))
+        index = np.flatnonzero(range_mask(a, preds[:1]))
+        for k, v_min, v_max in preds[1:]:
+            if index.size == 0:
+                break
+            values = _field_at(a, k, index)
+            index = index[(values >= v_min) & (values <= v_max)]
+        return index
+
+    def filter_mask(self, a):
+        """ Boolean mask of the entries in a that are within bounds """
+        if self.statistics is not None:
+            good = np.zeros(a.shape, dtype=bool)
+            good[self.filter_index(a)] = True
+            return good
+        # print "Filter with limits {0}".format(lim)
+        return range_mask(a, self.predicates(a))
+        
     @coroutine
     def filter(self):
         """ We set up the bounds and target here to save on lookup overhead.
@@ -48,7 +175,6 @@ class BoundsFilter(Segment):
 
             Initialize with a matplotlib axes instance that is the target plot.
         """
-        bounds = self.bounds
         target = self.target
         # coords_xy = self.ax_bundle.ax_specs[self.ax_bundle.panels['xy']]
         # coords_tz = self.ax_bundle.ax_specs[self.ax_bundle.panels['tz']]
@@ -57,26 +183,263 @@ class BoundsFilter(Segment):
         
         while True:
             a = (yield)
-            lim = bounds.limits()
-            good = np.ones(a.shape, dtype=bool)
-            # print "Filter with limits {0}".format(lim)
-            
-            for k, (v_min, v_max) in lim:
-                if self.restrict_to is not None:
-                    if not(k in self.restrict_to):
+            if self.statistics is not None:
+                target.send(select(a, self.filter_index(a)))
+            else:
+                target.send(select(a, self.filter_mask(a)))
+
+
+def _bits_dtype(n):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n <= 8*np.dtype(dtype).itemsize:
+            return dtype
+    raise ValueError("Can't hold {0} variables in a bitmask".format(n))
+
+
+class PanelsBoundsFilter(BoundsFilter):
+    """ Filters data separately for each panel of a set of linked axes, using
+        only the limits on the coordinates shown by that panel, so that, e.g.,
+        an xy panel shows all altitudes and times within its x and y limits.
+
+        ax_specs is {ax:(xname, yname), ...}, as in LinkedPanels.ax_specs, and
+        panel_targets is {ax:target, ...}. Variables listed in shared filter 
+        every panel. 
+
+        Each variable's range test is evaluated once for all panels, and the
+        results packed into a per-record bitmask, from which each panel selects
+        the records that pass the tests for its own variables. When the data
+        are a versioned Selection (see NamedArrayDataset(selections=True)), the
+        range test for each variable is only redone when its limits change.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.ax_specs = kwargs.pop('ax_specs', {})
+        self.panel_targets = kwargs.pop('panel_targets', {})
+        self.shared = tuple(kwargs.pop('shared', ()))
+        super(PanelsBoundsFilter, self).__init__(*args, **kwargs)
+        self._masks = {}
+        self._masks_source = None
+
+    def panel_variables(self, ax):
+        return tuple(self.ax_specs[ax]) + self.shared
+
+    def variable_masks(self, a):
+        """ Return {bounds_name:mask} of the range tests for each bounded 
+            variable of a, reusing masks for unchanged limits if possible.
+        """
+        key = _source_key(a)
+        if not _same_source(key, self._masks_source):
+            self._masks = {}
+        self._masks_source = key
+        masks = {}
+        for bounds_k, k, v_min, v_max in self.bounded_predicates(a):
+            test = (k, v_min, v_max)
+            cached = self._masks.get(bounds_k)
+            if (cached is not None) and (cached[0] == test):
+                masks[bounds_k] = cached[1]
+            else:
+                values = a[k]
+                masks[bounds_k] = (values >= v_min) & (values <= v_max)
+            self._masks[bounds_k] = (test, masks[bounds_k])
+        return masks
+
+    def variable_bits(self, a):
+        """ Returns (bits, names). Bit i of bits[j] is set if record j passes 
+            the range test on bounded variable names[i].
+        """
+        masks = self.variable_masks(a)
+        names = sorted(masks)
+        dtype = _bits_dtype(max(1, len(names)))
+        bits = np.zeros(a.shape, dtype=dtype)
+        for i, name in enumerate(names):
+            bits |= masks[name].astype(dtype) << dtype(i)
+        return bits, names
+
+    @coroutine
+    def filter_panels(self):
+        while True:
+            a = (yield)
+            bits, names = self.variable_bits(a)
+            for ax, target in self.panel_targets.items():
+                panel_bits = 0
+                for name in self.panel_variables(ax):
+                    if name in names:
+                        panel_bits |= 1 << names.index(name)
+                panel_bits = bits.dtype.type(panel_bits)
+                good = (bits & panel_bits) == panel_bits
+                target.send(select(a, good))
+
+
+class PrefetchingBoundsFilter(BoundsFilter):
+    """ A BoundsFilter that, after filtering, predicts the views the user is
+        likely to go to next (a pan by one view width, in either direction,
+        of each bounded variable, and a zoom out by a factor of two) and 
+        filters the data for those views in a background thread.
+
+        The selections for the predicted views are kept in an LRU cache of at
+        most max_views entries and max_bytes. Their limits are rounded out to
+        a multiple of quantum times the width of the view, so that nearby 
+        predictions share an entry. When a later view lies within the limits
+        of a cached selection, only the records in that selection are filtered.
+
+        Prefetching only happens for data sent as versioned Selections (see
+        NamedArrayDataset(selections=True)); the cache is emptied when the 
+        data change. Only a weak reference to the data is kept between 
+        predictions. Call close() to stop the background thread.
+    """
+
+    # filter also starts the prefetch, so it can't be replaced by filter_mask
+    fusable = False
+
+    def __init__(self, *args, **kwargs):
+        self.quantum = kwargs.pop('quantum', 0.125)
+        max_views = kwargs.pop('max_views', 16)
+        max_bytes = kwargs.pop('max_bytes', None)
+        super(PrefetchingBoundsFilter, self).__init__(*args, **kwargs)
+        self.cache = ByteBudgetCache(max_bytes=max_bytes, max_items=max_views)
+        self._lock = threading.Lock()
+        # (weak reference to base, version, index) of the data last filtered
+        self._source = None
+        self._pending = None
+        self._work = threading.Condition(self._lock)
+        self._worker = None
+        self._closing = False
+
+    def _current_source(self):
+        """ (base, version, index) of the data last filtered, or None """
+        if self._source is None:
+            return None
+        base = self._source[0]()
+        if base is None:
+            return None
+        return (base,) + self._source[1:]
+
+    def _set_source(self, key):
+        self._source = None
+        if key is not None:
+            try:
+                self._source = (weakref.ref(key[0]),) + key[1:]
+            except TypeError:
+                # e.g., a memoryview, which isn't prefetched
+                pass
+
+    def _quantize(self, v_min, v_max, width):
+        step = self.quantum*width
+        if not (step > 0):
+            return v_min, v_max
+        return np.floor(v_min/step)*step, np.ceil(v_max/step)*step
+
+    def predicted_bounds(self):
+        """ List of Bounds for the views that are likely to come next """
+        limits = [(k, lim) for k, lim in self.bounds.limits() 
+                  if (lim[0] is not None) and (lim[1] is not None)]
+        views = []
+        zoom_out = {}
+        for k, (v_min, v_max) in limits:
+            width = v_max - v_min
+            for shift in (-width, width):
+                pan = dict(limits)
+                pan[k] = self._quantize(v_min + shift, v_max + shift, width)
+                views.append(pan)
+            zoom_out[k] = self._quantize(v_min - 0.5*width, v_max + 0.5*width, width)
+        views.append(zoom_out)
+        return [Bounds(**view) for view in views]
+
+    def _lookup(self, preds):
+        """ The index of a cached selection that contains the records within
+            preds, or None.
+        """
+        for key in self.cache.keys():
+            cached = dict((k, (v_min, v_max)) for k, v_min, v_max in key)
+            if set(cached) != set(k for k, v_min, v_max in preds):
+                continue
+            if all((cached[k][0] <= v_min) and (v_max <= cached[k][1]) for k, v_min, v_max in preds):
+                return self.cache.get(key)
+        return None
+
+    def filter_index(self, a, bounds=None):
+        with self._lock:
+            if not _same_source(_source_key(a), self._current_source()):
+                return super(PrefetchingBoundsFilter, self).filter_index(a, bounds)
+            preds = self.ordered_predicates(a, bounds)
+            index = self._lookup(preds)
+        if index is None:
+            return super(PrefetchingBoundsFilter, self).filter_index(a, bounds)
+        if index.size == 0:
+            return index
+        return index[range_mask(select(a, index), preds)]
+
+    def prefetch(self, a, index=None):
+        """ Filter a for the predicted views, in the background. index is 
+            the selection for the current view, which is also cached.
+        """
+        key = _source_key(a)
+        with self._lock:
+            if not _same_source(key, self._current_source()):
+                self.cache.clear()
+                self._set_source(key)
+            if self._source is None:
+                return
+            if index is not None:
+                self.cache.put(tuple(sorted(self.predicates(a))), index)
+            self._pending = (a, key, self.predicted_bounds())
+            self._work.notify()
+            if self._worker is None:
+                self._closing = False
+                self._worker = threading.Thread(target=self._prefetch_worker, name='stormdrain prefetch')
+                self._worker.daemon = True
+                self._worker.start()
+
+    def close(self):
+        """ Stop the background thread, and forget the cached selections and
+            the data they were filtered from. Filtering starts it again.
+        """
+        with self._lock:
+            worker = self._worker
+            self._closing = True
+            self._pending = None
+            self._work.notify()
+        if worker is not None:
+            worker.join()
+        with self._lock:
+            if self._worker is worker:
+                self._worker = None
+            self.cache.clear()
+            self._source = None
+
+    def _prefetch_worker(self):
+        while True:
+            with self._lock:
+                while (self._pending is None) and not self._closing:
+                    self._work.wait()
+                if self._closing:
+                    return
+                a, key, views = self._pending
+                self._pending = None
+            for bounds in views:
+                with self._lock:
+                    if ((self._pending is not None) or self._closing or 
+                            not _same_source(key, self._current_source())):
+                        # newer predictions have replaced these
+                        break
+                    preds = tuple(sorted(self.predicates(a, bounds)))
+                    if (preds in self.cache) or (self._lookup(preds) is not None):
                         continue
-                if k in self.transform_mapping:
-                    new_k, transform_func = self.transform_mapping[k]
-                    v_min, v_max = transform_func((v_min, v_max))
-                    k = new_k
-                if k not in a.dtype.names:
-                    # ensure that this array even has data of bounds_type=k
-                    # implicitly ignores this bound, instead of returning empty
-                    continue
-                good &= (a[k] >= v_min) & (a[k] <= v_max)
-            
-            
-            target.send(a[good])
+                index = super(PrefetchingBoundsFilter, self).filter_index(a, bounds)
+                with self._lock:
+                    if _same_source(key, self._current_source()):
+                        self.cache.put(preds, index)
+            # Don't keep the data alive while waiting for the next predictions
+            a = key = index = None
+
+    @coroutine
+    def filter(self):
+        while True:
+            a = (yield)
+            index = self.filter_index(a)
+            self.target.send(select(a, index))
+            self.prefetch(a, index)
+            a = index = None
 
 
 class Bounds(object):
@@ -84,30 +447,104 @@ class Bounds(object):
         variables.  Bounds can be optionally initialized with another Bounds
         instance as a parent.  If bounds for a particular variable cannot be found
         within itself, the Bounds will try its parent.
+
+        Every change to a bounded variable increments version, which also
+        counts changes to the parent, so that results computed from a set of
+        bounds can be remembered until the bounds change.
+
+        Within a transaction(), version is incremented only once, at the end,
+        no matter how many bounds were changed.
+
+        The limits of this Bounds and all its parents are looked up once, and
+        remembered until any of them change.
     """
 
+    _internal = ('_parent', '_vars', '_version', '_transaction_depth', '_transaction_changed',
+                 '_children', '_flat')
+
     def __init__(self, parent = None, **kwargs):
-        self._parent = parent
+        self._children = weakref.WeakSet()
+        self._flat = None
         self._vars = []
+        self._version = 0
+        self._transaction_depth = 0
+        self._transaction_changed = False
+        self._parent = parent
         for bound, limits in kwargs.items():
             setattr(self, bound, limits)
 
     def __getattr__(self, attr):
         #If we're in this function, a straight lookup of the attribute within
         #the instance's dictionary has failed.  Therefore, we look to the
-        #parent, if one exists, otherwise
-        if self._parent:
-            return getattr(self._parent, attr)
-        else:
-            return (None, None)
+        #flattened limits of the parents, if any, otherwise
+        if attr in self._internal:
+            raise AttributeError(attr)
+        return self._flattened()[1].get(attr, (None, None))
 
     def __setattr__(self, attr, val):
-        if attr not in ['_parent','_vars']:
+        if attr not in self._internal:
             # Check to see if we already have a value for this attribute. If so, just change the value.
             # Only look at vars, not parent, since want to be able to override parent
             if attr not in self._vars:
                 self._vars.append(attr)
+            if self._transaction_depth > 0:
+                self.__dict__['_transaction_changed'] = True
+            else:
+                self.__dict__['_version'] += 1
+        elif attr == '_parent' and (val is not None):
+            val._children.add(self)
         self.__dict__[attr] = val
+        if attr in ('_parent', '_version') or (attr not in self._internal):
+            self._invalidate()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_children'] = None
+        state['_flat'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__['_children'] = weakref.WeakSet()
+        if self._parent is not None:
+            self._parent._children.add(self)
+
+    def _invalidate(self):
+        """ Forget the flattened limits of this and any child Bounds """
+        self.__dict__['_flat'] = None
+        for child in list(self._children):
+            child._invalidate()
+
+    def _flattened(self):
+        """ (version, {name:limits}, ((name, limits), ...)) for this Bounds
+            and all its parents, computed once after each change.
+        """
+        flat = self._flat
+        if flat is None:
+            if self._parent:
+                version, parent_limits, parent_items = self._parent._flattened()
+                version += self._version
+            else:
+                version, parent_items = self._version, ()
+            items = tuple((v, self.__dict__[v]) for v in self._vars)
+            items += tuple((v, lim) for v, lim in parent_items if v not in self.__dict__)
+            flat = self.__dict__['_flat'] = (version, dict(items), items)
+        return flat
+
+    @contextmanager
+    def transaction(self):
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            if (self._transaction_depth == 0) and self._transaction_changed:
+                self._transaction_changed = False
+                self._version += 1
+
+    @property
+    def version(self):
+        return self._flattened()[0]
 
     def __getitem__(self, var):
         return getattr(self, var)
@@ -115,13 +552,34 @@ class Bounds(object):
     def __iter__(self):
         #Return an iterator over all bounded variables, including those in
         #parent
-        if self._parent:
-            return iter(self._vars +
-                [v for v in self._parent if v not in self._vars])
-        else:
-            return iter(self._vars)
+        return iter([v for v, lim in self._flattened()[2]])
     
     def limits(self):
-        vars = [v for v in self]
-        return zip(vars, (getattr(self, v) for v in vars))
+        """ Sequence of (name, limits) for all bounded variables """
+        return self._flattened()[2]
+
+    def arrays(self):
+        """ The limits as arrays: names, v_mins, v_maxs. Limits that are None
+            are -inf or +inf.
+        """
+        items = self.limits()
+        names = [v for v, lim in items]
+        v_mins = np.array([-np.inf if lim[0] is None else lim[0] for v, lim in items], dtype=float)
+        v_maxs = np.array([np.inf if lim[1] is None else lim[1] for v, lim in items], dtype=float)
+        return names, v_mins, v_maxs
+
+    def to_dict(self):
+        """ The limits of all bounded variables, including those of the 
+            parent, as {name:(v_min, v_max)} of plain Python numbers, suitable
+            for sending to another process.
+        """
+        d = {}
+        for name, lim in self.limits():
+            d[name] = tuple(None if v is None else v.item() if hasattr(v, 'item') else v 
+                            for v in lim)
+        return d
+
+    @classmethod
+    def from_dict(cls, d, parent=None):
+        return cls(parent=parent, **d)
 
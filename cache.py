@@ -0,0 +1,105 @@
+""" Caches for data that flow through pipelines.
+
+    The size of each entry is measured in bytes, so that the cache can be
+    limited by a memory budget instead of by a count of entries that may each
+    be very large, as is the case for arrays of a whole dataset.
+
+"""
+
+from collections import OrderedDict
+
+
+def nbytes(obj):
+    """ Estimate the memory held by obj, which may be an array, anything
+        else with an nbytes attribute, or a tuple/list/dict of those.
+        Anything else counts as zero bytes.
+    """
+    if isinstance(obj, (tuple, list)):
+        return sum(nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(nbytes(o) for o in obj.values())
+    return int(getattr(obj, 'nbytes', 0))
+
+
+class ByteBudgetCache(object):
+    """ A mapping that evicts entries once the total size of the entries 
+        exceeds max_bytes, or their number exceeds max_items. Either limit may
+        be None for no limit.
+
+        policy is 'lru' to evict the least recently used entry first, or 
+        'fifo' to evict the oldest entry first.
+
+        The stats dictionary counts hits, misses, and evictions.
+    """
+
+    policies = ('lru', 'fifo')
+
+    def __init__(self, max_bytes=None, max_items=None, policy='lru'):
+        if policy not in self.policies:
+            raise ValueError("Cache policy {0!r} is not one of {1}".format(policy, self.policies))
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.policy = policy
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.total_bytes = 0
+        self.stats = {'hits':0, 'misses':0, 'evictions':0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        return list(self._entries.keys())
+
+    def values(self):
+        return list(self._entries.values())
+
+    def get(self, key, default=None):
+        """ Return the value for key and mark it as recently used """
+        if key not in self._entries:
+            self.stats['misses'] += 1
+            return default
+        self.stats['hits'] += 1
+        if self.policy == 'fifo':
+            return self._entries[key]
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value, size=None):
+        """ Store value under key. size defaults to nbytes(value). """
+        if size is None:
+            size = nbytes(value)
+        self.discard(key)
+        self._entries[key] = value
+        self._sizes[key] = size
+        self.total_bytes += size
+        self._evict()
+
+    def discard(self, key):
+        if key in self._entries:
+            del self._entries[key]
+            self.total_bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.total_bytes = 0
+
+    def _over_budget(self):
+        if (self.max_items is not None) and (len(self._entries) > self.max_items):
+            return True
+        if (self.max_bytes is not None) and (self.total_bytes > self.max_bytes):
+            return True
+        return False
+
+    def _evict(self):
+        # The most recent entry is kept even if it alone exceeds the budget,
+        # so that whoever just stored it can still use it.
+        while (len(self._entries) > 1) and self._over_budget():
+            key = next(iter(self._entries))
+            self.discard(key)
+            self.stats['evictions'] += 1
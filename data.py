@@ -3,8 +3,9 @@ from functools import wraps
 import numpy as np
 from numpy.lib.recfunctions import append_fields
 
-from stormdrain.pubsub import get_exchange
+from stormdrain.pubsub import get_exchange, PRIORITY_DATA
 from stormdrain.pipeline import coroutine
+from stormdrain.selection import Selection, as_array
 
 class BaseDate(object):
     def __init__(self, date):
@@ -31,16 +32,37 @@ def indexed(index_name=_default_index_name):
 
         
 class NamedArrayDataset(object):
-    def __init__(self, data, target=None):
+    exchange_priority = PRIORITY_DATA
+
+    def __init__(self, data, target=None, selections=False, weak=False):
+        """ If selections is True, data are sent down the pipeline as a 
+            stormdrain.selection.Selection, so that filters pass along an index
+            into data instead of copies of the selected records.
+
+            version counts changes to data, by update() or by assignment of
+            a new data array, and is carried by the selections that are sent.
+
+            If weak is True, the dataset is attached to SD_reflow_start by a 
+            weak reference, so that it and its data are collected once nobody
+            else holds on to it. Otherwise it reflows for as long as the 
+            exchange exists.
+        """
         self.target = target
+        self.version = 0
         self.data = data
+        self.selections = selections
         self.reflow_start_xchg = get_exchange('SD_reflow_start')
 
-        # Need to find a way to detach when "done" with dataset. __del__ doesn't work
-        # because of some gc issues. context manager doesn't exactly work, since the
-        # dataset objects are not one-shot tasks; they live for the whole lifecycle.
-        # Anyway, ignoring for now.
-        self.reflow_start_xchg.attach(self)
+        self.reflow_start_xchg.attach(self, weak=weak)
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.version += 1
     
     @coroutine
     def update(self, index_name=_default_index_name, field_names=None):
@@ -59,11 +81,15 @@ class NamedArrayDataset(object):
                     self.data[field_name][indices] = a[field_name]
             else:
                 # update everything
-                self.data[indices] = a
+                self.data[indices] = as_array(a)
+            self.version += 1
                         
     def send(self, msg):
         """ SD_reflow_start messages are sent here """
         # print 'Data object got message {0}'.format(msg)
         if self.target is not None:
             # print 'Sending from Data.'
-            self.target.send(self.data)
+            if self.selections:
+                self.target.send(Selection(self.data, version=self.version))
+            else:
+                self.target.send(self.data)
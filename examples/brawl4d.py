@@ -5,11 +5,11 @@
 
 import numpy as np
 
-from stormdrain.bounds import BoundsFilter
+from stormdrain.bounds import BoundsFilter, FieldStatistics
 from stormdrain.data import NamedArrayDataset
-from stormdrain.pipeline import Branchpoint
+from stormdrain.pipeline import Branchpoint, register
 
-from stormdrain.support.matplotlib.linked import LinkedPanels
+from stormdrain.support.matplotlib.linked import LinkedPanels, ViewHistory
 from stormdrain.support.matplotlib.mplevents import MPLaxesManager
 from stormdrain.support.matplotlib.artistupdaters import PanelsScatterController, FigureUpdater
 from stormdrain.support.coords.filters import CoordinateSystemController
@@ -78,28 +78,30 @@ if __name__ == '__main__':
                        dtype = [ ('name', '|S32'), ('lat', '>f4'), ('lon', '>f4'), 
                                  ('alt', '>f4'), ('time', '>f4') ]  )
     # Create a dataset that stores numpy named array data, and automatically receives updates 
-    # when the bounds of a plot changes.
-    d = NamedArrayDataset(data)
+    # when the bounds of a plot changes. With selections=True, filters pass along indices
+    # into data instead of copies of the records.
+    d = NamedArrayDataset(data, selections=True)
     
     # Create a scatterplot representation of the dataset, and add the necessary transforms
     # to get the data to the plot. In this case, it's a simple filter on the plot bounds, and 
     # distribution to all the scatter artists. Might also add map projection here if the plot
     # were not directly showing lat, lon, alt.
-    scatter_ctrl = PanelsScatterController(panels=panels, color_field='time')
-    scatter_outlet_broadcaster = scatter_ctrl.branchpoint
-    scatter_updater = scatter_outlet_broadcaster.broadcast()
-    branch = Branchpoint([scatter_updater,])
-    brancher = branch.broadcast()
-    bound_filter = BoundsFilter(target=brancher, bounds=panels.bounds)
-    filterer = bound_filter.filter()
-    d.target = filterer
+    # Changes to the axes limits while the plot is set up lead to only one reflow,
+    # when the transaction completes.
+    with panels.transaction():
+        scatter_ctrl = PanelsScatterController(panels=panels, color_field='time')
+        scatter_outlet_broadcaster = scatter_ctrl.branchpoint
+        scatter_updater = scatter_outlet_broadcaster.broadcast()
+        # Statistics on the data let the filter test the most selective bounds first.
+        stats = FieldStatistics(data, fields=('lat', 'lon', 'alt', 'time'))
+        pipe = register([(BoundsFilter, 'filter', {'bounds':panels.bounds, 'statistics':stats}),
+                         (Branchpoint, 'broadcast', {}),
+                        ], target=scatter_updater)
+        branch = pipe.find(Branchpoint)
+        d.target = pipe.inlet
     
-    # Set an initial view.
-    panels.panels['xy'].axis((-110, -90, 30, 40))
-    panels.panels['tz'].axis((0, 10, 0, 5e3))
-    # Shouldn't need these, since the previous two cover all coordinates
-    # panels.panels['zy'].axis((0, 5e3, 30, 40,))
-    # panels.panels['xz'].axis((-110, -90, 0, 5e3))
+        # Set an initial view.
+        panels.set_limits(lon=(-110, -90), lat=(30, 40), time=(0, 10), alt=(0, 5e3))
 
 
 
@@ -120,7 +122,14 @@ if __name__ == '__main__':
 
     # tap into the data that result from subsetting on the first axes.
     branch.targets.add(cs_transformer)
-    panels2.panels['xy'].axis((-1000, 1000, -1000, 1000))
-    panels2.panels['tz'].axis((0, 10, 0, 5))
+    panels2.set_limits(x=(-1000, 1000), y=(-1000, 1000), time=(0, 10), z=(0, 5))
+
+    # Remember recent views of the data, so that going back to one of them (e.g., 
+    # with the toolbar's back button) redraws both figures without a reflow. The
+    # branchpoints before the first figure's outlets and after the projection are
+    # wrapped, so d is neither filtered nor projected again.
+    panels.history = ViewHistory(panels.bounds, max_bytes=200e6, datasets=[d])
+    panels.history.wrap(scatter_ctrl.branchpoint)
+    panels.history.wrap(scatter_ctrl2.branchpoint)
     
     plt.show()
\ No newline at end of file
@@ -0,0 +1,169 @@
+""" Kernels for the loops over every record that are run on each reflow.
+
+    Where numba is installed, the kernels are compiled to make a single pass
+    over the data without the intermediate boolean arrays of the equivalent
+    NumPy expressions. Otherwise, or if use_jit is set to False, the same
+    results are computed with NumPy (and matplotlib, for polygons).
+
+    benchmark() compares the two.
+"""
+
+import time
+
+import numpy as np
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    numba = None
+    HAVE_NUMBA = False
+
+# Set to False to always use the NumPy versions of the kernels
+use_jit = HAVE_NUMBA
+
+
+if HAVE_NUMBA:
+    # The range tests are combined with & rather than and, so that there is no
+    # branch to mispredict for each record, which made these slower than NumPy.
+
+    @numba.njit(cache=True, nogil=True)
+    def _range_mask_jit(columns, v_mins, v_maxs, out):
+        # One pass over records, for columns that all have the same dtype
+        k = len(columns)
+        for i in range(out.shape[0]):
+            ok = True
+            for j in range(k):
+                v = columns[j][i]
+                ok &= (v >= v_mins[j]) & (v <= v_maxs[j])
+            out[i] = ok
+        return out
+
+    @numba.njit(cache=True, nogil=True)
+    def _and_range_jit(values, v_min, v_max, out):
+        for i in range(out.shape[0]):
+            v = values[i]
+            out[i] &= (v >= v_min) & (v <= v_max)
+        return out
+
+    @numba.njit(cache=True, nogil=True)
+    def _points_in_polygon_jit(x, y, vx, vy, out):
+        # Crossing test as in matplotlib's point_in_path, so that the
+        # results are the same.
+        n_verts = vx.shape[0]
+        for i in range(x.shape[0]):
+            tx, ty = x[i], y[i]
+            inside = False
+            if not (np.isfinite(tx) and np.isfinite(ty)):
+                # as matplotlib, which finds no NaN point inside
+                out[i] = False
+                continue
+            x0, y0 = vx[n_verts-1], vy[n_verts-1]
+            yflag0 = y0 >= ty
+            for j in range(n_verts):
+                x1, y1 = vx[j], vy[j]
+                yflag1 = y1 >= ty
+                if yflag0 != yflag1:
+                    if (((y1 - ty)*(x0 - x1) >= (x1 - tx)*(y0 - y1)) == yflag1):
+                        inside = not inside
+                x0, y0, yflag0 = x1, y1, yflag1
+            out[i] = inside
+        return out
+
+
+def _jittable(*arrays):
+    for values in arrays:
+        if (values.ndim != 1) or (values.dtype.kind not in 'iuf'):
+            return False
+    return True
+
+def _native(values):
+    """ values in native byte order, which the compiled kernels require """
+    if values.dtype.isnative:
+        return values
+    return values.astype(values.dtype.newbyteorder('='))
+
+
+def range_mask(a, predicates, jit=None):
+    """ Boolean mask of the records in a with v_min <= a[name] <= v_max for
+        every (name, v_min, v_max) in predicates. A limit of None is unbounded.
+    """
+    if jit is None:
+        jit = use_jit
+    predicates = [(k, -np.inf if v_min is None else v_min, np.inf if v_max is None else v_max)
+                  for k, v_min, v_max in predicates]
+    columns = [a[k] for k, v_min, v_max in predicates]
+    if jit and HAVE_NUMBA and predicates and _jittable(*columns):
+        columns = [_native(values) for values in columns]
+        # compare in the same precision as NumPy would
+        limits = []
+        for values, (k, v_min, v_max) in zip(columns, predicates):
+            dtype = np.result_type(values, v_min, v_max)
+            limits.append((dtype.type(v_min), dtype.type(v_max)))
+        dtypes = set(values.dtype for values in columns)
+        if (len(dtypes) == 1) and (columns[0].dtype.kind == 'f'):
+            # the limits are exactly representable as float64
+            v_mins = np.array([lim[0] for lim in limits], dtype=float)
+            v_maxs = np.array([lim[1] for lim in limits], dtype=float)
+            out = np.empty(len(columns[0]), dtype=bool)
+            return _range_mask_jit(tuple(columns), v_mins, v_maxs, out)
+        out = np.ones(len(columns[0]), dtype=bool)
+        for values, (v_min, v_max) in zip(columns, limits):
+            _and_range_jit(values, v_min, v_max, out)
+        return out
+    good = np.ones(a.shape, dtype=bool)
+    for values, (k, v_min, v_max) in zip(columns, predicates):
+        good &= (values >= v_min) & (values <= v_max)
+    return good
+
+
+def points_in_polygon(x, y, verts, jit=None):
+    """ Boolean mask of the points (x, y) that are inside the polygon verts """
+    if jit is None:
+        jit = use_jit
+    # as in matplotlib, the points are tested in double precision
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    verts = np.asarray(verts, dtype=float)
+    if jit and HAVE_NUMBA and (len(verts) > 0) and (x.ndim == 1):
+        vx = np.ascontiguousarray(verts[:, 0])
+        vy = np.ascontiguousarray(verts[:, 1])
+        out = np.empty(x.shape, dtype=bool)
+        return _points_in_polygon_jit(x, y, vx, vy, out)
+    from matplotlib import path
+    if x.size == 0:
+        return np.zeros(x.shape, dtype=bool)
+    p = path.Path(verts)
+    return p.contains_points(np.column_stack((x, y))) == 1
+
+
+def benchmark(a, predicates=(), coord_names=None, verts=None, repeat=5):
+    """ Time the compiled and NumPy versions of range_mask(a, predicates),
+        and of points_in_polygon for the fields coord_names of a if verts are
+        given. Returns {kernel:{'numpy':seconds, 'jit':seconds, 'same':bool}},
+        with the best of repeat trials; 'jit' is None without numba.
+    """
+    kernels = {'range_mask': lambda jit: range_mask(a, list(predicates), jit=jit)}
+    if verts is not None:
+        x, y = a[coord_names[0]], a[coord_names[1]]
+        kernels['points_in_polygon'] = lambda jit: points_in_polygon(x, y, verts, jit=jit)
+    results = {}
+    for name, kernel in kernels.items():
+        result = {'jit':None, 'same':None}
+        for path, jit in (('numpy', False), ('jit', True)):
+            if jit and not HAVE_NUMBA:
+                continue
+            out = kernel(jit) # compile, if needed
+            best = None
+            for i in range(repeat):
+                t0 = time.time()
+                kernel(jit)
+                elapsed = time.time() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            result[path] = best
+            result[path + '_result'] = out
+        if result['jit'] is not None:
+            result['same'] = bool(np.array_equal(result['numpy_result'], result['jit_result']))
+        del result['numpy_result']
+        result.pop('jit_result', None)
+        results[name] = result
+    return results
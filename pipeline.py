@@ -1,45 +1,42 @@
 """ 
-Idea for standardized hookup and vis of pipelines.
+Standardized hookup and visualization of pipelines.
 
-Requires that every segment's class takes target as the first argument to init, 
-and kwargs thereafter. 
+Requires that every segment's class takes target as a keyword argument to init, 
+and kwargs thereafter. Branchpoint, which takes a sequence of targets, is 
+also recognized.
 
-This might just be better handled by convention in writing them from scratch - use nested
-parentheses and good formatting instead of a programmatic solution. The getattr(methname) is
-pretty ugly, honestly. Why not simply register a list of instances and target coroutines? DRY?
+Pipelines can still be written by hand, using nested parentheses and good 
+formatting, but register builds the same chain of coroutines from a list of 
+(class, coroutine method name, kwargs) specifications, checks it, and can 
+print the resulting topology.
 
-segments = [(Segment, 'segment_func', {}),
-            (BoundsFilter, 'filter', {'bounds':bounds}),
-            (BoundsFilter, 'filter', {'bounds':bounds}),
-            (Broadcast, 'broadcast', {})
+segments = [(BoundsFilter, 'filter', {'bounds':bounds}),
+            (LassoFilter, 'filter', {'coord_names':('x','y'), 'verts':verts}),
+            (Branchpoint, 'broadcast', {})
            ]
+pipe = register(segments, target=outlet)
+dataset.target = pipe.inlet
+print(pipe.describe())
 
-End of the segment (first one inited) one does not require a target, and should be either Broadcast or an outlet.
+The segments are listed in the order data flow through them. The last one
+receives target; if target is None it should be a Branchpoint (whose targets
+can be added later) or an outlet.
 
-register(segments, prior_segment=None, subsequent_segment=None)
+Consecutive segments that produce a boolean mask (those that implement
+filter_mask(a), such as BoundsFilter and LassoFilter) are fused into a single
+MaskFilter, so that the array is subset once instead of once per filter.
 
-from itertools import reversed
-def register(segments, subsequent_segment=None):
-    segchain = []
-    seg = subsequent_segment
-    for cls, meth, kws in reversed(segments):
-        seg_reference = cls(subsequent_segment, **kws)
-        crt = getattr(seg_reference, meth)
-        seg = crt()
-
-        segchain.append((seg_reference, seg))
-        
-    return segchain
-    
-        
 """
 
 
 import time
-from collections import deque
+import weakref
 
 import numpy as np
 
+from stormdrain.cache import ByteBudgetCache, nbytes
+from stormdrain.selection import Selection, as_array, select
+
 def coroutine(func):
     def start(*args,**kwargs):
         cr = func(*args,**kwargs)
@@ -113,10 +110,50 @@ class ItemModifier(Segment):
         while True:
             a, value = (yield)
             if self.name_to_modify is not None:
+                # modify a copy of the records, not a base array that a Selection refers to
+                a = as_array(a)
                 a[self.name_to_modify] = value
                 self.target.send(a)
                 
 
+class MaskFilter(Segment):
+    """ Subsets the data in the pipe once, using the combined (logical and)
+        mask of several mask-producing filters.
+
+        Each of the filters kwarg implements filter_mask(a), which returns
+        a boolean array with the same shape as a. Stacking BoundsFilter and
+        LassoFilter segments copies the array once per segment; fusing their
+        masks here copies it only once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.filters = list(kwargs.pop('filters', []))
+        super(MaskFilter, self).__init__(*args, **kwargs)
+
+    def filter_mask(self, a):
+        good = np.ones(a.shape, dtype=bool)
+        for f in self.filters:
+            if not good.any():
+                # nothing left to filter
+                break
+            good &= f.filter_mask(a)
+        return good
+
+    @coroutine
+    def filter(self):
+        while True:
+            a = (yield)
+            self.target.send(select(a, self.filter_mask(a)))
+
+
+class _BaseIndex(object):
+    """ Stands in for a cached Selection of base """
+    def __init__(self, index, version):
+        self.index = index
+        self.version = version
+        self.nbytes = getattr(index, 'nbytes', 0)
+
+
 class CachedTriggerableSegment(object):
     """ Mediates use of a pipelines by caching and resending on demand the last-received data
 
@@ -125,27 +162,189 @@ class CachedTriggerableSegment(object):
 
         The caching behavior assumes that there is only one inlet and one outlet - it's a straight coupler.
 
+        The history can also be limited to max_bytes, evicting entries by policy ('lru' or 'fifo') 
+        once over budget. If base (an array, or a dataset with a data attribute) is given, arrays
+        that are views into base are not counted against the budget, and Selections of base (see
+        NamedArrayDataset(selections=True)) are stored only as their index into base, and resent
+        as a Selection of the records in base at the time of the resend. Selections of another
+        array count that array against the budget, since they keep it alive.
+        Statistics on cache use are in self.stats.
     """
-    def __init__(self, target=None, cache_len=1):
+    def __init__(self, target=None, cache_len=1, max_bytes=None, policy='lru', base=None):
         """ target is an activated coroutine."""
         self.target = target
-        self.cache = deque([], cache_len)
+        self.cache = ByteBudgetCache(max_bytes=max_bytes, max_items=cache_len, policy=policy)
+        self.base = base
+        self._received = 0
         # self.inlet = self.cache_segment()
 
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    def _base_array(self):
+        if (self.base is None) or isinstance(self.base, np.ndarray):
+            return self.base
+        return self.base.data
+
+    def _compact(self, stuff):
+        """ Return what to store in the cache for stuff, and its size in bytes """
+        base = self._base_array()
+        if base is None:
+            return stuff, nbytes(stuff)
+        if isinstance(stuff, Selection):
+            if stuff.base is base:
+                stored = _BaseIndex(stuff.index, stuff.version)
+                return stored, stored.nbytes
+            return stuff, nbytes(stuff) + nbytes(stuff.base)
+        if isinstance(stuff, np.ndarray) and np.may_share_memory(stuff, base):
+            # Already a view into the base data
+            return stuff, 0
+        return stuff, nbytes(stuff)
+
     @coroutine
     def cache_segment(self):
         while True:
             stuff = (yield)
-            self.cache.append(stuff)
+            stored, size = self._compact(stuff)
+            self.cache.put(self._received, stored, size=size)
+            self._received += 1
             # self.resend()
 
     def resend_last(self, n=1):
-        # convert to list so we can use slicing
-        for v in list(self.cache)[-n:]:
+        # keys count up as data are received, so the most recent are last
+        keys = sorted(self.cache.keys())[-n:]
+        self.cache.stats['misses'] += max(0, n - len(keys))
+        for key in keys:
+            v = self.cache.get(key)
+            if isinstance(v, _BaseIndex):
+                v = Selection(self._base_array(), v.index, 
+                              version=getattr(self.base, 'version', v.version))
             self.target.send(v)
 
 
 
+class MemoizedSegment(object):
+    """ Shares the output of a pipeline segment among several branches that
+        apply the same transformation to the same data.
+
+        segment is a function that accepts a target and returns an activated
+        coroutine, e.g., lambda target: cs.project_points(target=target).
+        key is a hashable description of the parameters of the segment, or a
+        function that returns one at the time data arrive.
+
+        MemoizedSegments that are given the same cache (a 
+        cache.ByteBudgetCache) and the same key share results: the first one
+        to receive an array runs segment, and the others resend its output.
+        Results are remembered for the identity (and version, if any) of the
+        incoming data, so call cache.clear() if data are modified in place.
+
+        >>> shared = ByteBudgetCache(max_bytes=200e6)
+        >>> project = lambda target: cs.project_points(target=target)
+        >>> key = lambda: ('project', cs.ctr_lat, cs.ctr_lon, cs.ctr_alt)
+        >>> branch.targets.add(MemoizedSegment(target=outlet1, segment=project, key=key, cache=shared).memoize())
+        >>> branch.targets.add(MemoizedSegment(target=outlet2, segment=project, key=key, cache=shared).memoize())
+    """
+    def __init__(self, target=None, segment=None, key=None, cache=None):
+        self.target = target
+        self.key = key
+        if cache is None:
+            cache = ByteBudgetCache(max_items=1)
+        self.cache = cache
+        self._outputs = []
+        self._segment = segment(self._capture())
+
+    @coroutine
+    def _capture(self):
+        while True:
+            output = (yield)
+            self._outputs.append(output)
+
+    def _cache_key(self, a):
+        params = self.key() if callable(self.key) else self.key
+        return (id(a), getattr(a, 'version', None), params)
+
+    @coroutine
+    def memoize(self):
+        while True:
+            a = (yield)
+            key = self._cache_key(a)
+            entry = self.cache.get(key)
+            if (entry is not None) and (entry[0]() is a):
+                outputs = entry[1]
+            else:
+                # id(a) may have been reused by new data, so also check that
+                # the cached entry was computed from this very object.
+                self._outputs = []
+                self._segment.send(a)
+                outputs = self._outputs
+                try:
+                    a_ref = weakref.ref(a)
+                except TypeError:
+                    a_ref = lambda: a
+                self.cache.put(key, (a_ref, outputs), size=nbytes(outputs))
+            for output in outputs:
+                self.target.send(output)
+            del a
+
+
+class LazySegment(object):
+    """ Pull-based coupler: holds on to the most recently received data instead
+        of sending it on, until an outlet asks for it with pull().
+
+        Place one of these ahead of the segments feeding a figure that may not
+        be on screen, and give it to that figure's FigureUpdater. Reflows then
+        only mark the segment dirty, and the work downstream is done at draw
+        time, if at all.
+
+        If bounds is given, data are only resent when the data or bounds.version
+        have changed since the last pull, so several outlets pulling in turn
+        share one computation per version of the bounds. Call invalidate() if
+        the data were modified in place.
+    """
+    def __init__(self, target=None, bounds=None):
+        """ target is an activated coroutine."""
+        self.target = target
+        self.bounds = bounds
+        self._pending = None
+        self._received = False
+        self._pulled_key = None
+
+    @coroutine
+    def defer(self):
+        while True:
+            a = (yield)
+            if a is not self._pending:
+                self._pulled_key = None
+            self._pending = a
+            self._received = True
+            if self.bounds is None:
+                # nothing to key the result on, so every delivery is new.
+                self._pulled_key = None
+
+    def _key(self):
+        if self.bounds is None:
+            return True
+        return self.bounds.version
+
+    @property
+    def dirty(self):
+        return self._received and (self._pulled_key != self._key())
+
+    def invalidate(self):
+        self._pulled_key = None
+
+    def pull(self):
+        """ Send the held data to target, if it has not been sent already.
+            Returns True if data were sent.
+        """
+        if not self.dirty:
+            return False
+        self._pulled_key = self._key()
+        self.target.send(self._pending)
+        return True
+
+
 class Branchpoint(object):
     """ Class-based version useful for tracking a changing state or adjusting targets
         at a later time. Some '.dot' access overhead this way, of course.
@@ -170,3 +369,126 @@ class Branchpoint(object):
                 target.send(stuff)
             del stuff
 
+
+class SegmentChain(object):
+    """ The result of register: a chain of segments built from a spec.
+
+        stages is a list of (description, instance, coroutine), in the order
+        that data flow through them. inlet is the coroutine that receives data.
+    """
+
+    def __init__(self, stages, target=None):
+        self.stages = stages
+        self.target = target
+
+    @property
+    def inlet(self):
+        if self.stages:
+            return self.stages[0][2]
+        return self.target
+
+    def find(self, cls):
+        """ Return the first segment instance in the chain of class cls,
+            including the filters that were fused into a MaskFilter.
+        """
+        for desc, instance, crt in self.stages:
+            if isinstance(instance, cls):
+                return instance
+            if isinstance(instance, MaskFilter):
+                for f in instance.filters:
+                    if isinstance(f, cls):
+                        return f
+        return None
+
+    def describe(self):
+        """ Return a printable, one-stage-per-line view of the topology """
+        lines = []
+        for i, (desc, instance, crt) in enumerate(self.stages):
+            prefix = '  -> ' if i > 0 else ''
+            if isinstance(instance, Branchpoint):
+                desc += ' ({0} targets)'.format(len(instance.targets))
+            lines.append(prefix + desc)
+        if self.target is not None:
+            lines.append('  -> {0!r}'.format(self.target))
+        return '\n'.join(lines)
+
+
+def _check_spec(spec):
+    """ Normalize a (cls, meth) or (cls, meth, kwargs) spec, and make sure it
+        describes a segment that can be built.
+    """
+    if len(spec) == 2:
+        cls, meth = spec
+        kws = {}
+    elif len(spec) == 3:
+        cls, meth, kws = spec
+    else:
+        raise ValueError("Segment spec {0!r} should be (class, method name, kwargs)".format(spec))
+    if not isinstance(cls, type):
+        raise ValueError("Segment spec {0!r} does not start with a class".format(spec))
+    if not callable(getattr(cls, meth, None)):
+        raise ValueError("{0} has no coroutine method {1!r}".format(cls.__name__, meth))
+    if not isinstance(kws, dict):
+        raise ValueError("kwargs for {0}.{1} should be a dict".format(cls.__name__, meth))
+    if 'target' in kws:
+        raise ValueError("target for {0}.{1} is assigned by register".format(cls.__name__, meth))
+    return cls, meth, kws
+
+
+def _is_mask_filter(cls, meth):
+    return (meth == 'filter') and hasattr(cls, 'filter_mask') and getattr(cls, 'fusable', True)
+
+
+def register(segments, target=None, fuse=True):
+    """ Build a pipeline from segments, a list of (class, method name, kwargs)
+        listed in the order that data flow through them. target receives the
+        output of the last segment.
+
+        If fuse is True, runs of consecutive mask-producing filters are
+        combined into one MaskFilter. Filters whose filter does more than
+        send the masked data set fusable = False.
+
+        Returns a SegmentChain; send data to its inlet.
+    """
+    specs = [_check_spec(spec) for spec in segments]
+
+    # Group the specs so that each group becomes one stage of the chain
+    groups = []
+    for cls, meth, kws in specs:
+        if (fuse and groups and _is_mask_filter(cls, meth)
+                and all(_is_mask_filter(c, m) for c, m, k in groups[-1])):
+            groups[-1].append((cls, meth, kws))
+        else:
+            groups.append([(cls, meth, kws)])
+
+    # Hook up in reverse order, so that each segment's target exists.
+    stages = []
+    downstream = target
+    for group in reversed(groups):
+        if len(group) > 1:
+            filters = [cls(**kws) for cls, meth, kws in group]
+            instance = MaskFilter(target=downstream, filters=filters)
+            crt = instance.filter()
+            desc = ' + '.join('{0}.{1}'.format(cls.__name__, meth) 
+                              for cls, meth, kws in group) + ' (fused)'
+        else:
+            cls, meth, kws = group[0]
+            if issubclass(cls, Branchpoint):
+                kws = dict(kws)
+                targets = list(kws.pop('targets', []))
+                if downstream is not None:
+                    targets.append(downstream)
+                instance = cls(targets, **kws)
+            elif downstream is None and issubclass(cls, Segment):
+                raise ValueError("{0}.{1} would send to a target of None".format(cls.__name__, meth))
+            elif downstream is None:
+                instance = cls(**kws)
+            else:
+                instance = cls(target=downstream, **kws)
+            crt = getattr(instance, meth)()
+            desc = '{0}.{1}'.format(cls.__name__, meth)
+        stages.append((desc, instance, crt))
+        downstream = crt
+
+    stages.reverse()
+    return SegmentChain(stages, target=target)
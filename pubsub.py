@@ -4,8 +4,12 @@
     
     Formally, this could be repalced a register / unregister procedure for new modules,
     with perhaps some sort of descriptor of what sort of events are actually sent.
-    In the meantime, the defaultdict suffices to allow the basic idea of subscription
-    and distribution to be demonstrated.
+    In the meantime, a dictionary of exchanges created on first use suffices to allow 
+    the basic idea of subscription and distribution to be demonstrated.
+
+    To find which subscribers are slow to respond to an event, turn on metrics
+    with enable_metrics() or recording_metrics(), and then look at exchanges() or
+    metrics_snapshot().
 
     Adapted from
     https://github.com/dabeaz/python-cookbook/blob/master/src/12/implementing_publish_subscribe_messaging/exchange2.py
@@ -13,20 +17,231 @@
 """
 
 
+import heapq
+import itertools
+import threading
+import time
+import weakref
 from contextlib import contextmanager
 from collections import defaultdict
 
-class Exchange:
-    """ Manually attach and detach, or subscribe with a context manager."""
+
+# Subscribers receive each message in order of increasing priority: data are
+# reflowed before the artists showing them are styled, and both before the
+# figures are drawn. A subscriber's priority is the priority kwarg to attach,
+# or else its exchange_priority attribute, or else PRIORITY_DATA.
+#
+# Messages are often sent by the subscribers of another exchange, e.g., 
+# LinkedPanels sends SD_bounds_updated, SD_reflow_start and SD_reflow_done
+# when it receives MPL_interaction_complete, maybe more than once for linked
+# axes. Within such a cascade of sends, subscribers at PRIORITY_DRAW or later,
+# on any exchange, are deferred until the first send is done, after all the 
+# data and styling, and each of them then receives only the last message it
+# was sent.
+PRIORITY_DATA = 0
+PRIORITY_STYLE = 10
+PRIORITY_DRAW = 20
+
+
+class _NoChange(object):
+    def __repr__(self):
+        return 'NO_CHANGE'
+
+# Returned from a subscriber's send to say that the message changed nothing,
+# so subscribers attached to run after it need not receive the message.
+NO_CHANGE = _NoChange()
+
+
+class _StrongRef(object):
+    """ Same interface as weakref.ref, for subscribers that are kept alive
+        by the exchange.
+    """
+    __slots__ = ('_task',)
+
+    def __init__(self, task):
+        self._task = task
+
+    def __call__(self):
+        return self._task
+
+
+def _identity_ref(task):
+    """ A reference to task that doesn't keep it alive, if possible """
+    try:
+        return weakref.ref(task)
+    except TypeError:
+        return _StrongRef(task)
+
+
+# Whether exchanges record ExchangeMetrics; see enable_metrics()
+_metrics_enabled = False
+
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    _timer = time.time
+
+
+def _describe(task):
+    name = getattr(task, '__qualname__', None) or type(task).__name__
+    return '{0} at {1:#x}'.format(name, id(task))
+
+
+class _DispatchState(threading.local):
+    """ Per thread, how deeply sends are nested, and the subscribers deferred
+        until the outermost send is done.
+    """
+    def __init__(self):
+        self.depth = 0
+        # id(task) -> [priority, sequence, exchange, subscription, task, msg, deps known unchanged]
+        self.deferred = {}
+        self.sequence = itertools.count()
+
+_dispatch_state = _DispatchState()
+
+
+class ExchangeMetrics(object):
+    """ Counts of the messages sent on an exchange, the total time to send
+        them to all subscribers (fan-out), and for each subscriber, keyed by a
+        description of the subscriber, [count, total_time, max_time]. Times 
+        are in seconds.
+    """
     def __init__(self):
-        self._subscribers = set()
+        self.reset()
+
+    def reset(self):
+        self.messages = 0
+        self.fanout_time = 0.0
+        self.subscribers = {}
+
+    def record_subscriber(self, task, elapsed):
+        stats = self.subscribers.get(_describe(task))
+        if stats is None:
+            stats = self.subscribers[_describe(task)] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+    def record_message(self, elapsed):
+        self.messages += 1
+        self.fanout_time += elapsed
+
+    def snapshot(self):
+        return {'messages':self.messages, 'fanout_time':self.fanout_time,
+                'subscribers':dict((k, {'count':v[0], 'total_time':v[1], 'max_time':v[2]})
+                                   for k, v in self.subscribers.items())}
+
 
-    def attach(self, task):
+class _Subscription(object):
+    __slots__ = ('ref', 'priority', 'after', 'order')
+
+    def __init__(self, ref, priority, after, order):
+        self.ref = ref
+        self.priority = priority
+        self.after = after
+        self.order = order
+
+
+class Exchange:
+    """ Manually attach and detach, or subscribe with a context manager.
+
+        Subscribers attached with weak=True are held by a weak reference, and
+        are dropped from the exchange once they are garbage collected.
+
+        Messages are sent to subscribers in order of priority (see 
+        PRIORITY_DATA, etc.), and then in the order they were attached, 
+        except that a subscriber attached with after=(task, ...) always 
+        follows those tasks. If all of those tasks return NO_CHANGE from 
+        send (or were themselves skipped), the subscriber is skipped. send 
+        returns NO_CHANGE if no subscriber reported a change.
+
+        Each send goes to the subscribers that were attached when it started,
+        so subscribers may attach and detach during a send, and from other 
+        threads. 
+
+        A send from within another send (on this or any other exchange) 
+        defers the subscribers at PRIORITY_DRAW or later, and those attached 
+        to follow them, until the outermost send is done. They are then sent
+        their last message, by priority, and their result isn't known to the
+        send that deferred them.
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.metrics = ExchangeMetrics()
+        # A tuple of subscriptions in dispatch order, replaced (never 
+        # modified) under the lock. Reentrant, since a weak reference may 
+        # die while the lock is held.
+        self._subscribers = ()
+        self._lock = threading.RLock()
+        self._counter = itertools.count()
+
+    def attach(self, task, weak=False, priority=None, after=()):
         # could enforce recognized exchange name here
-        self._subscribers.add(task)
+        with self._lock:
+            if any(sub.ref() is task for sub in self._subscribers):
+                return
+            if weak:
+                ref = weakref.ref(task, self._discard_ref)
+            else:
+                ref = _StrongRef(task)
+            if priority is None:
+                priority = getattr(task, 'exchange_priority', PRIORITY_DATA)
+            after = tuple(_identity_ref(dep) for dep in after)
+            sub = _Subscription(ref, priority, after, next(self._counter))
+            self._subscribers = self._dispatch_order(self._subscribers + (sub,))
 
     def detach(self, task):
-        self._subscribers.remove(task)
+        with self._lock:
+            subscribers = tuple(sub for sub in self._subscribers if sub.ref() is not task)
+            if len(subscribers) == len(self._subscribers):
+                raise KeyError(task)
+            self._subscribers = subscribers
+
+    def _discard_ref(self, dead_ref):
+        with self._lock:
+            self._subscribers = tuple(sub for sub in self._subscribers if sub.ref is not dead_ref)
+
+    @staticmethod
+    def _dispatch_order(subscriptions):
+        """ Sort subscriptions topologically by their after dependencies, 
+            and otherwise by priority and the order they were attached.
+        """
+        by_task = {}
+        for sub in subscriptions:
+            task = sub.ref()
+            if task is not None:
+                by_task[id(task)] = sub
+        waiting_on = {}
+        followers = defaultdict(list)
+        for sub in subscriptions:
+            deps = set()
+            for dep_ref in sub.after:
+                dep_task = dep_ref()
+                if dep_task is None:
+                    continue
+                dep = by_task.get(id(dep_task))
+                if (dep is not None) and (dep is not sub):
+                    deps.add(dep.order)
+                    followers[dep.order].append(sub)
+            waiting_on[sub.order] = deps
+        ready = [(sub.priority, sub.order, sub) for sub in subscriptions if not waiting_on[sub.order]]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            priority, order, sub = heapq.heappop(ready)
+            ordered.append(sub)
+            for follower in followers[order]:
+                waiting_on[follower.order].discard(order)
+                if not waiting_on[follower.order]:
+                    heapq.heappush(ready, (follower.priority, follower.order, follower))
+        if len(ordered) != len(subscriptions):
+            raise ValueError("Subscribers' after dependencies form a cycle")
+        return tuple(ordered)
+
+    @property
+    def subscribers(self):
+        """ The subscribers that are still alive, in dispatch order """
+        return [task for task in (sub.ref() for sub in self._subscribers) if task is not None]
 
     @contextmanager
     def subscribe(self, *tasks):
@@ -38,17 +253,164 @@ class Exchange:
             for task in tasks:
                 self.detach(task)
 
+    @staticmethod
+    def _live_deps(sub):
+        return [dep for dep in (dep_ref() for dep_ref in sub.after) if dep is not None]
+
+    def _send_to(self, subscriber, msg, measured):
+        if not measured:
+            return subscriber.send(msg)
+        t0 = _timer()
+        result = subscriber.send(msg)
+        self.metrics.record_subscriber(subscriber, _timer() - t0)
+        return result
+
+    def _dispatch(self, subscribers, msg):
+        # Read once, so that a message is measured completely or not at all
+        measured = _metrics_enabled
+        if measured:
+            start = _timer()
+        state = _dispatch_state
+        nested = state.depth > 0
+        unchanged = set()
+        deferred = set()
+        changed = False
+        state.depth += 1
+        try:
+            for sub in subscribers:
+                subscriber = sub.ref()
+                if subscriber is None:
+                    continue
+                deps = self._live_deps(sub)
+                if deps and all(id(dep) in unchanged for dep in deps):
+                    unchanged.add(id(subscriber))
+                    continue
+                if nested and ((sub.priority >= PRIORITY_DRAW) or 
+                               any(id(dep) in deferred for dep in deps)):
+                    deferred.add(id(subscriber))
+                    self._defer(state, sub, subscriber, msg, 
+                                set(id(dep) for dep in deps if id(dep) in unchanged))
+                    changed = True
+                    continue
+                if self._send_to(subscriber, msg, measured) is NO_CHANGE:
+                    unchanged.add(id(subscriber))
+                else:
+                    changed = True
+        except BaseException:
+            state.depth -= 1
+            if state.depth == 0:
+                state.deferred.clear()
+            raise
+        state.depth -= 1
+        if measured:
+            self.metrics.record_message(_timer() - start)
+        if (state.depth == 0) and state.deferred:
+            _run_deferred(state)
+        if not changed:
+            return NO_CHANGE
+
+    def _defer(self, state, sub, subscriber, msg, known_unchanged):
+        entry = state.deferred.get(id(subscriber))
+        if entry is None:
+            # Those followed by the subscriber might have been deferred at a 
+            # lower priority, so it must not run before them.
+            priority = sub.priority
+            for dep in self._live_deps(sub):
+                dep_entry = state.deferred.get(id(dep))
+                if dep_entry is not None:
+                    priority = max(priority, dep_entry[0])
+            state.deferred[id(subscriber)] = [priority, next(state.sequence), self, sub, 
+                                              subscriber, msg, known_unchanged]
+        else:
+            entry[2:] = [self, sub, subscriber, msg, known_unchanged]
+
     def send(self, msg):
-        for subscriber in self._subscribers:
-            subscriber.send(msg)
+        return self._dispatch(self._subscribers, msg)
+
+    def send_many(self, msgs):
+        """ Send each of msgs, in order, to the same set of subscribers. """
+        subscribers = self._subscribers
+        for msg in msgs:
+            self._dispatch(subscribers, msg)
+
+
+def _run_deferred(state):
+    """ Send the deferred subscribers their last messages, by priority. Sends
+        from within them are again deferred until these are done.
+    """
+    measured = _metrics_enabled
+    while state.deferred:
+        entries = sorted(state.deferred.values(), key=lambda entry: entry[:2])
+        state.deferred = {}
+        unchanged = set()
+        state.depth += 1
+        try:
+            for priority, sequence, exchange, sub, subscriber, msg, known_unchanged in entries:
+                deps = exchange._live_deps(sub)
+                if deps and all((id(dep) in unchanged) or (id(dep) in known_unchanged) 
+                                for dep in deps):
+                    unchanged.add(id(subscriber))
+                    continue
+                if exchange._send_to(subscriber, msg, measured) is NO_CHANGE:
+                    unchanged.add(id(subscriber))
+        except BaseException:
+            state.deferred.clear()
+            raise
+        finally:
+            state.depth -= 1
 
 
 # Dictionary of all created exchanges
-_exchanges = defaultdict(Exchange)
+_exchanges = {}
+_exchanges_lock = threading.Lock()
 
 # Return the Exchange instance associated with a given name
 def get_exchange(name):
-    return _exchanges[name]
+    with _exchanges_lock:
+        if name not in _exchanges:
+            _exchanges[name] = Exchange(name)
+        return _exchanges[name]
+
+def exchanges():
+    """ List of {'name', 'subscribers', 'messages', 'fanout_time'} for every
+        exchange created with get_exchange.
+    """
+    return [{'name':name, 'subscribers':len(x.subscribers), 
+             'messages':x.metrics.messages, 'fanout_time':x.metrics.fanout_time}
+            for name, x in sorted(_exchanges.items())]
+
+def enable_metrics(enabled=True):
+    """ Turn on (or off) recording of ExchangeMetrics by all exchanges """
+    global _metrics_enabled
+    _metrics_enabled = enabled
+
+def reset_metrics():
+    for x in list(_exchanges.values()):
+        x.metrics.reset()
+
+def metrics_snapshot():
+    """ {name:ExchangeMetrics.snapshot()} for every exchange """
+    return dict((name, x.metrics.snapshot()) for name, x in list(_exchanges.items()))
+
+@contextmanager
+def recording_metrics():
+    """ Record metrics, starting from zero, for the duration of the block.
+        The dictionary that is returned is filled with metrics_snapshot() at
+        the end of the block:
+
+        with recording_metrics() as metrics:
+            panels.panels['xy'].axis((-105, -95, 32, 38))
+        print(metrics['SD_reflow_start']['subscribers'])
+    """
+    was_enabled = _metrics_enabled
+    reset_metrics()
+    enable_metrics(True)
+    snapshot = {}
+    try:
+        yield snapshot
+    finally:
+        enable_metrics(was_enabled)
+        snapshot.update(metrics_snapshot())
 
 # Example of using the subscribe() method
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+""" Relay exchange messages between processes, so that linked views can each
+    run in their own process, with their own pipelines.
+
+    Each end of a connection (a multiprocessing Pipe, or a Connection from
+    multiprocessing.connection.Listener/Client for local sockets) gets an
+    ExchangeRelay, which forwards messages sent on the named local exchanges
+    to the other end. Received messages are sent on the local exchanges when
+    the relay is polled, for instance from a GUI timer:
+
+        parent_end, child_end = multiprocessing.Pipe()
+        relay = ExchangeRelay(parent_end)
+        timer = figure.canvas.new_timer(interval=50)
+        timer.add_callback(relay.poll)
+        timer.start()
+
+    Bounds are sent as {name:(v_min, v_max)}, and received as a new Bounds
+    instance. By default, they arrive on SD_remote_bounds_updated, where
+    LinkedPanels adopts them as its own limits, followed by the relayed
+    SD_reflow_start and SD_reflow_done. SD_replay_reflow_start, sent when a
+    view is replayed from a ViewHistory, arrives as SD_reflow_start, since the
+    other end has no record of the view. Other messages must be picklable.
+"""
+
+from stormdrain.bounds import Bounds
+from stormdrain.pubsub import get_exchange
+
+_bounds_tag = 'stormdrain.Bounds'
+
+default_inbound = {'SD_bounds_updated':'SD_remote_bounds_updated',
+                   'SD_replay_reflow_start':'SD_reflow_start'}
+
+
+def encode(msg):
+    if isinstance(msg, Bounds):
+        return (_bounds_tag, msg.to_dict())
+    return msg
+
+def decode(payload):
+    if isinstance(payload, tuple) and (len(payload) == 2) and (payload[0] == _bounds_tag):
+        return Bounds.from_dict(payload[1])
+    return payload
+
+
+class _Forwarder(object):
+    """ Subscribes to one local exchange on behalf of an ExchangeRelay """
+    def __init__(self, relay, name):
+        self.relay = relay
+        self.name = name
+
+    def send(self, msg):
+        self.relay.forward(self.name, msg)
+
+
+class ExchangeRelay(object):
+    """ Forwards messages on the local exchanges names across connection, and
+        sends messages received from connection on the local exchange given
+        by inbound[name], or name if not in inbound.
+    """
+    def __init__(self, connection, names=('SD_bounds_updated', 'SD_reflow_start', 'SD_replay_reflow_start',
+                                         'SD_reflow_done'),
+                 inbound=None):
+        self.connection = connection
+        self.names = tuple(names)
+        if inbound is None:
+            inbound = default_inbound
+        self.inbound = inbound
+        self._delivering = False
+        self.forwarders = []
+        for name in self.names:
+            forwarder = _Forwarder(self, name)
+            get_exchange(name).attach(forwarder)
+            self.forwarders.append(forwarder)
+
+    def close(self):
+        for forwarder in self.forwarders:
+            get_exchange(forwarder.name).detach(forwarder)
+        self.forwarders = []
+        self.connection.close()
+
+    def forward(self, name, msg):
+        if self._delivering:
+            # Don't echo messages that came from the other end
+            return
+        self.connection.send((name, encode(msg)))
+
+    def poll(self, timeout=0.0):
+        """ Send any messages that have been received on the local exchanges.
+            Returns the number of messages.
+        """
+        count = 0
+        while self.connection.poll(timeout):
+            try:
+                name, payload = self.connection.recv()
+            except EOFError:
+                break
+            self._delivering = True
+            try:
+                get_exchange(self.inbound.get(name, name)).send(decode(payload))
+            finally:
+                self._delivering = False
+            count += 1
+            timeout = 0.0
+        return count
@@ -0,0 +1,135 @@
+""" Selections stand for a subset of the records in a base array, without
+    copying those records.
+
+    A filter that receives an array and sends a[mask] copies every field of
+    every selected record, and the next filter copies them again. If instead
+    the data at the inlet of a pipeline are sent as Selection(data), each
+    filter composes its mask with the selection, and only the index of the
+    selected records travels down the pipe. Fields are copied only when an
+    outlet asks for them, e.g. sel['x'], and whole records only when an
+    outlet calls as_array.
+
+"""
+
+import numpy as np
+
+
+def _slice_length(start, stop, step):
+    if step > 0:
+        return max(0, (stop - start + step - 1) // step)
+    return max(0, (start - stop - step - 1) // (-step))
+
+
+class Selection(object):
+    """ The records base[index], where index is an integer index array or a
+        slice. Fields are retrieved with sel['name'], and a further subset is
+        selected with sel[mask] or sel.select(mask), which returns a new
+        Selection of the same base array.
+
+        version optionally identifies the state of base when the selection
+        was made, and is passed on to selections derived from this one.
+    """
+
+    def __init__(self, base, index=None, version=None):
+        if index is None:
+            index = slice(0, len(base), 1)
+        self.base = base
+        self.index = index
+        self.version = version
+
+    def __repr__(self):
+        return 'Selection({0} of {1} records)'.format(len(self), len(self.base))
+
+    def __len__(self):
+        if isinstance(self.index, slice):
+            return _slice_length(*self.index.indices(len(self.base)))
+        return len(self.index)
+
+    @property
+    def size(self):
+        return len(self)
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    @property
+    def nbytes(self):
+        """ Memory held by this selection, not counting the base array """
+        return getattr(self.index, 'nbytes', 0)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            # Only this field is copied (or, for a slice, viewed)
+            return self.base[key][self.index]
+        return self.select(key)
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.materialize()
+        if dtype is not None:
+            a = a.astype(dtype)
+        return a
+
+    def select(self, which):
+        """ Select the subset which (a boolean mask, an integer index array, or
+            a slice) of the records in this selection.
+        """
+        if isinstance(which, slice):
+            if isinstance(self.index, slice):
+                return Selection(self.base, self._compose_slices(which), version=self.version)
+            return Selection(self.base, self.index[which], version=self.version)
+
+        which = np.asarray(which)
+        if which.dtype == bool:
+            which = np.flatnonzero(which)
+            if isinstance(self.index, slice):
+                start, stop, step = self.index.indices(len(self.base))
+                if (step == 1) and (len(which) > 0) and (which[-1] - which[0] + 1 == len(which)):
+                    # contiguous records stay a slice
+                    first = start + int(which[0])
+                    return Selection(self.base, slice(first, first + len(which), 1), version=self.version)
+        if isinstance(self.index, slice):
+            start, stop, step = self.index.indices(len(self.base))
+            index = start + which.astype(np.intp) * step
+        else:
+            index = self.index[which]
+        return Selection(self.base, index, version=self.version)
+
+    def _compose_slices(self, which):
+        start, stop, step = self.index.indices(len(self.base))
+        w_start, w_stop, w_step = which.indices(len(self))
+        count = _slice_length(w_start, w_stop, w_step)
+        if count == 0:
+            return slice(0, 0, 1)
+        new_start = start + w_start*step
+        new_step = step*w_step
+        new_stop = new_start + count*new_step
+        if new_stop < 0:
+            new_stop = None
+        return slice(new_start, new_stop, new_step)
+
+    def materialize(self):
+        """ Return the selected records as an array. For a slice, this is a
+            view into base.
+        """
+        return self.base[self.index]
+
+
+def as_array(a):
+    """ Return a as an array, copying the records out of a Selection if
+        necessary. Outlets that need whole records call this.
+    """
+    if isinstance(a, Selection):
+        return a.materialize()
+    return a
+
+
+def select(a, which):
+    """ Subset a, which may be a Selection or an array, by which. """
+    if isinstance(a, Selection):
+        return a.select(which)
+    return a[which]
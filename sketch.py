@@ -0,0 +1,151 @@
+""" Approximate quantiles of data that arrive in pieces.
+
+    A QuantileSketch summarizes any number of values in a few thousand of
+    them, and is updated with each new chunk of values instead of being
+    recomputed from all the values seen so far. Two sketches merge into the
+    sketch of both sets of values, so that chunks sketched separately (for
+    instance, in other processes) can be combined.
+
+    sketch = QuantileSketch()
+    for chunk in chunks:
+        sketch.update(chunk['power'])
+    p_lo, p_hi = sketch.quantiles((0.01, 0.99))
+
+    The sketch is a stack of compactors, as in Karnin, Lang and Liberty
+    (2016): level h holds values that each stand for 2**h of the values
+    seen. When a level fills up, it is sorted and every other value, from a
+    random offset, moves up a level. The rank of a quantile is typically
+    off by a small multiple of count/k.
+"""
+
+import numpy as np
+
+from stormdrain.pipeline import coroutine, Segment
+
+
+class QuantileSketch(object):
+    """ Mergeable sketch of the distribution of a stream of values. Larger k
+        is more accurate and holds more values. NaN values are ignored. The
+        count, min and max of the values are exact.
+    """
+
+    def __init__(self, k=256, seed=None):
+        self.k = k
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.levels = [np.empty(0, dtype=float)]
+        self._random = np.random.RandomState(seed)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return 'QuantileSketch(k={0}, {1} values in {2})'.format(
+                    self.k, self.count, self.size)
+
+    @property
+    def size(self):
+        """ Number of values held by the sketch """
+        return sum(len(level) for level in self.levels)
+
+    def copy(self):
+        other = QuantileSketch(k=self.k)
+        other.count, other.min, other.max = self.count, self.min, self.max
+        other.levels = [level.copy() for level in self.levels]
+        other._random.set_state(self._random.get_state())
+        return other
+
+    def update(self, values):
+        """ Add the values in the array values """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+        self._extend(values.min(), values.max(), values.size)
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """ Add the values summarized by the sketch other """
+        if other.count == 0:
+            return self
+        self._extend(other.min, other.max, other.count)
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0, dtype=float))
+            self.levels[h] = np.concatenate((self.levels[h], level))
+        self._compress()
+        return self
+
+    def _extend(self, v_min, v_max, count):
+        if self.count == 0:
+            self.min, self.max = v_min, v_max
+        else:
+            self.min, self.max = min(self.min, v_min), max(self.max, v_max)
+        self.count += count
+
+    def _compress(self):
+        # Compact blocks of 2k values at a time, so that a large update is
+        # sorted in pieces of 2k and not all at once.
+        block, half = 2*self.k, self.k
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            n_blocks = len(level) // block
+            if n_blocks > 0:
+                n = n_blocks*block
+                blocks = np.sort(level[:n].reshape(n_blocks, block), axis=1)
+                offsets = self._random.randint(0, 2, size=n_blocks)
+                keep = offsets[:, None] + 2*np.arange(half)[None, :]
+                promoted = blocks[np.arange(n_blocks)[:, None], keep].ravel()
+                self.levels[h] = level[n:]
+                if h+1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=float))
+                self.levels[h+1] = np.concatenate((self.levels[h+1], promoted))
+            h += 1
+
+    def quantiles(self, qs):
+        """ Approximate values at the quantiles qs, between 0 and 1. NaN if no
+            values have been seen.
+        """
+        qs = np.asarray(qs, dtype=float)
+        if self.count == 0:
+            return np.full(qs.shape, np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0**h)
+                                  for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind='mergesort')
+        values, ranks = values[order], np.cumsum(weights[order])
+        i = np.searchsorted(ranks, qs*self.count, side='left')
+        result = values[np.clip(i, 0, len(values)-1)]
+        # the extremes are known exactly
+        result = np.where(qs <= 0, self.min, result)
+        result = np.where(qs >= 1, self.max, result)
+        return result
+
+    def quantile(self, q):
+        return float(self.quantiles([q])[0])
+
+
+class SketchingSegment(Segment):
+    """ Updates sketch, a QuantileSketch, with the values of field in each
+        array that passes through, e.g., chunks of a dataset as they are loaded
+        or records as they are appended to it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.field = kwargs.pop('field')
+        self.sketch = kwargs.pop('sketch', None)
+        if self.sketch is None:
+            self.sketch = QuantileSketch()
+        super(SketchingSegment, self).__init__(*args, **kwargs)
+
+    @coroutine
+    def update(self):
+        while True:
+            a = (yield)
+            self.sketch.update(a[self.field])
+            if self.target is not None:
+                self.target.send(a)
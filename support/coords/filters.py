@@ -1,6 +1,7 @@
 from numpy.lib.recfunctions import append_fields
 
 from stormdrain.pipeline import coroutine
+from stormdrain.selection import as_array
 from stormdrain.support.coords.systems import MapProjection, GeographicSystem
 
 class CoordinateSystemController(object):
@@ -34,7 +35,7 @@ class CoordinateSystemController(object):
             Use distance_scale_factor to conveniently convert from m to km.
         """
         while True:
-            points = (yield)
+            points = as_array((yield))
             
             mapProj = self.mapProj
             geoProj = self.geoProj
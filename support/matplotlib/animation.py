@@ -1,10 +1,19 @@
 from __future__ import absolute_import
 import time
+import pickle
+import multiprocessing
 
 import numpy as np
 from matplotlib.animation import TimedAnimation
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8; workers get their own copy of the data instead.
+    shared_memory = None
+
 from stormdrain.pipeline import coroutine, CachedTriggerableSegment
+from stormdrain.selection import as_array
 
 class FixedDurationAnimation(TimedAnimation):
     """ If this gets too slow, might look at pre-rendered matplotlib ArtistAnimation for inspiration """
@@ -72,39 +81,195 @@ class PipelineAnimation(object):
             
             The data array to be animated should come from branchpoint_data_source, 
             an instance of pipeline.Branchpoint
+
+            The data are sorted by *variable* once, when the animation starts,
+            so that each frame is a view of the first records of the sorted 
+            data, found by bisection, instead of a scan and copy of all the data.
         """
         self.tstart = time.time()
         self.duration = duration
         self.outlets = outlets
         self.branchpoint_data_source = branchpoint_data_source
+        self.variable = variable
+        self.limits = limits
+
+        self._time_fraction = 0.0
+        self._source = None
+        self._sorted = None
+        self._sorted_values = None
         
-        self.filterer=self._filter_to_fraction(variable, limits)
+        self.sorter = self._sort_by_variable()
         
-        self.cache_trigger = CachedTriggerableSegment(target=self.filterer)
+        self.cache_trigger = CachedTriggerableSegment(target=self.sorter)
         self.cache_segment = self.cache_trigger.cache_segment()
         if branchpoint_data_source is not None:
             branchpoint_data_source.targets.add(self.cache_segment)
             
     def cleanup(self, animator):
         self.branchpoint_data_source.targets.remove(self.cache_segment)
-                
+
     @coroutine
-    def _filter_to_fraction(self, variable, limits):
-        start = limits[0]
-        limit_span = limits[1] - limits[0]
+    def _sort_by_variable(self):
+        """ Receives the data to be animated, sorts it by the animation 
+            variable if it hasn't been seen before, and sends the current frame.
+        """
         while True:
             a = (yield)
-            elapsed = self._time_fraction*limit_span
-            current = (a[variable] >= start) & (a[variable] <= (start + elapsed))
-            subset = a[current]
-            for updater in self.outlets:
-                updater.send(subset)
+            if a is not self._source:
+                self._source = a
+                a = as_array(a)
+                order = np.argsort(a[self.variable], kind='mergesort')
+                self._sorted = a[order]
+                self._sorted_values = self._sorted[self.variable]
+            self._send_frame()
+
+    def _send_frame(self):
+        values = self._sorted_values
+        start, end = self.limits
+        if start is None:
+            start = values[0] if len(values) > 0 else 0.0
+        if end is None:
+            end = values[-1] if len(values) > 0 else start
+        elapsed = self._time_fraction*(end - start)
+        first = np.searchsorted(values, start, side='left')
+        last = np.searchsorted(values, start + elapsed, side='right')
+        subset = self._sorted[first:max(first, last)]
+        for updater in self.outlets:
+            updater.send(subset)
         
     def draw_frame(self, animator, time_fraction):
         self._time_fraction = time_fraction
+        # Data that are already sorted are only sliced for this frame.
         self.cache_trigger.resend_last()
     
     def init_draw(self, animator):
         self._time_fraction = 0.0
         self.cache_trigger.resend_last()
         
+
+
+# State of each offline rendering worker process, set up by _init_render_worker
+_render_state = {}
+
+def _init_render_worker(figure_pickle, artists, data_info):
+    """ Unpickle the figure onto a headless Agg canvas, and attach to the 
+        time-sorted data.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = pickle.loads(figure_pickle)
+    canvas = FigureCanvasAgg(figure)
+    shm_name, dtype, shape, data = data_info
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # keep a reference, or the buffer is released
+        _render_state['shm'] = shm
+    _render_state['canvas'] = canvas
+    _render_state['data'] = data
+    _render_state['artists'] = [(figure.axes[ax_idx].collections[art_idx], coords, color_field)
+                                for ax_idx, art_idx, coords, color_field in artists]
+    for artist, coords, color_field in _render_state['artists']:
+        # Artists animated for blitting would otherwise be skipped by canvas.draw()
+        artist.set_animated(False)
+
+def _render_frame(task):
+    """ Draw the records data[first:last] and write a PNG to filename, or if
+        filename is None return the RGBA pixels of the frame.
+    """
+    frame, first, last, filename = task
+    canvas = _render_state['canvas']
+    subset = _render_state['data'][first:last]
+    for artist, coords, color_field in _render_state['artists']:
+        artist.set_offsets(np.column_stack((subset[coords[0]], subset[coords[1]])))
+        if color_field is not None:
+            artist.set_array(subset[color_field])
+    if filename is None:
+        canvas.draw()
+        return frame, bytes(canvas.buffer_rgba())
+    # print_png draws the figure itself
+    canvas.print_png(filename)
+    return frame, filename
+
+def render_animation_frames(figure, data, artists, duration, fps, variable='time', 
+                            limits=(None, None), output='frame_{0:05d}.png', stream=None, 
+                            processes=None):
+    """ Render an animation of *data* on *figure* offline, with the Agg 
+        backend, across a pool of *processes* (defaults to the number of CPUs).
+        The frames reveal the records in order of *variable* over *limits*, 
+        as PipelineAnimation does, for *duration* seconds at *fps* frames per
+        second.
+
+        *artists* is a sequence of (artist, (x_name, y_name), color_field) 
+        for the scatter collections on figure that show the data.
+
+        Frames are written as PNG files named by output.format(frame_number),
+        or, if *stream* (an open binary file) is given, as raw RGBA pixels in
+        frame order, suitable for, e.g., 
+            ffmpeg -f rawvideo -pix_fmt rgba -s WIDTHxHEIGHT -r FPS -i - out.mp4
+        where the size is figure.canvas.get_width_height().
+
+        Returns the list of filenames, or the number of frames written to stream.
+    """
+    # Only the fields that are drawn are sorted and shared with the workers.
+    fields = [variable]
+    artist_info = []
+    for artist, coords, color_field in artists:
+        ax_idx = figure.axes.index(artist.axes)
+        art_idx = artist.axes.collections.index(artist)
+        artist_info.append((ax_idx, art_idx, tuple(coords), color_field))
+        for name in tuple(coords) + (color_field,):
+            if (name is not None) and (name not in fields):
+                fields.append(name)
+    data = as_array(data)
+    order = np.argsort(data[variable], kind='mergesort')
+    packed = np.empty(data.shape, dtype=[(name, data.dtype[name]) for name in fields])
+    for name in fields:
+        packed[name] = data[name][order]
+    values = packed[variable]
+
+    start, end = limits
+    if start is None:
+        start = values[0] if len(values) > 0 else 0.0
+    if end is None:
+        end = values[-1] if len(values) > 0 else start
+    n_frames = max(1, int(round(duration*fps)))
+    first = np.searchsorted(values, start, side='left')
+    tasks = []
+    for frame in range(n_frames):
+        fraction = float(frame)/(n_frames-1) if n_frames > 1 else 1.0
+        last = np.searchsorted(values, start + fraction*(end - start), side='right')
+        filename = None if stream is not None else output.format(frame)
+        tasks.append((frame, first, max(first, last), filename))
+
+    shm = None
+    if (shared_memory is not None) and (packed.nbytes > 0):
+        shm = shared_memory.SharedMemory(create=True, size=packed.nbytes)
+        np.ndarray(packed.shape, dtype=packed.dtype, buffer=shm.buf)[:] = packed
+        data_info = (shm.name, packed.dtype, packed.shape, None)
+    else:
+        data_info = (None, None, None, packed)
+    init_args = (pickle.dumps(figure), artist_info, data_info)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, initializer=_init_render_worker, initargs=init_args)
+    try:
+        chunksize = max(1, n_frames // (4*processes))
+        results = []
+        for frame, result in pool.imap(_render_frame, tasks, chunksize):
+            if stream is not None:
+                stream.write(result)
+            else:
+                results.append(result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    if stream is not None:
+        return n_frames
+    return results
@@ -1,22 +1,162 @@
 from __future__ import absolute_import
+import weakref
+from collections import defaultdict
+
 import numpy as np
 
 from stormdrain.bounds import Bounds
 from stormdrain.pipeline import coroutine, Branchpoint, CachedTriggerableSegment
-from stormdrain.pubsub import get_exchange
-from stormdrain.support.matplotlib.animation import PipelineAnimation, FixedDurationAnimation
-from six.moves import zip
+from stormdrain.pubsub import get_exchange, NO_CHANGE, PRIORITY_STYLE, PRIORITY_DRAW
+from stormdrain.selection import Selection
+from stormdrain.sketch import QuantileSketch
+from stormdrain.support.matplotlib.animation import PipelineAnimation, FixedDurationAnimation, render_animation_frames
+from six.moves import zip, range
 
 class FigureUpdater(object):
-    def __init__(self, figure):
+    # Draw after all other subscribers to an exchange have updated the artists
+    exchange_priority = PRIORITY_DRAW
+
+    def __init__(self, figure, lazy_segments=None):
+        """ lazy_segments is an optional sequence of pipeline.LazySegment 
+            instances that feed the artists on figure. They are pulled just
+            before the figure is drawn, and not at all while the figure is
+            not visible.
+        """
         self.figure=figure
+        self.visible = True
+        self.lazy_segments = set()
+        if lazy_segments is not None:
+            self.lazy_segments.update(lazy_segments)
+        # A figure that is drawn for some other reason, such as its window 
+        # being brought back on screen, may have data waiting for it.
+        self.figure.canvas.mpl_connect('draw_event', self.on_draw)
         # Tell the figure to update (draw) when the bounds change.
         get_exchange('SD_reflow_done').attach(self)
+
+    def is_visible(self):
+        if not self.visible:
+            return False
+        # Qt canvases are widgets, and know if they have been hidden. 
+        # Other backends rely on self.visible being set.
+        canvas_visible = getattr(self.figure.canvas, 'isVisible', None)
+        if canvas_visible is not None:
+            return bool(canvas_visible())
+        return True
+
+    def set_visible(self, visible):
+        self.visible = visible
+        if visible:
+            self.send(None)
+
+    def pull(self):
+        """ Pull data from any dirty lazy segments. Returns True if any were pulled. """
+        pulled = False
+        for segment in self.lazy_segments:
+            pulled = segment.pull() or pulled
+        return pulled
+
+    def on_draw(self, event):
+        """ draw_event callback """
+        if self.pull():
+            self.figure.canvas.draw_idle()
         
     def send(self, bounds):
+        if not self.is_visible():
+            # Skip the draw. Lazy segments stay dirty until we're shown again.
+            return NO_CHANGE
+        self.pull()
         self.figure.canvas.draw()
 
 
+class _ArtistChangeListener(object):
+    """ Receives MPL_artist_updated messages on behalf of a BlittingFigureUpdater """
+    def __init__(self, updater):
+        self.updater = updater
+
+    def send(self, artist):
+        self.updater.artist_changed(artist)
+
+
+class BlittingFigureUpdater(FigureUpdater):
+    """ A FigureUpdater that redraws only the axes whose artists have new data.
+
+        Outlets report the artists they change with the MPL_artist_updated
+        exchange. Those artists are drawn as animated artists: each axes' 
+        static background (spines, ticks, other artists) is saved after a
+        full draw, and on reflow only the axes with changed artists are 
+        restored, have their animated artists drawn, and are blitted.
+
+        A full draw is done when any axes' limits or size have changed, when
+        an artist is first reported, or if the canvas doesn't support blitting.
+    """
+    def __init__(self, figure, lazy_segments=None):
+        self._animated = defaultdict(set)
+        self._changed = set()
+        self._backgrounds = {}
+        self._view_states = {}
+        self._full_draw_needed = True
+        super(BlittingFigureUpdater, self).__init__(figure, lazy_segments=lazy_segments)
+        self._artist_listener = _ArtistChangeListener(self)
+        get_exchange('MPL_artist_updated').attach(self._artist_listener)
+
+    def artist_changed(self, artist):
+        if artist.figure is not self.figure:
+            return
+        if artist not in self._animated[artist.axes]:
+            # The artist is in the saved backgrounds, so they must be redone.
+            artist.set_animated(True)
+            self._animated[artist.axes].add(artist)
+            self._full_draw_needed = True
+        self._changed.add(artist)
+
+    @staticmethod
+    def _view_state(ax):
+        return (tuple(ax.viewLim.bounds), tuple(ax.bbox.bounds))
+
+    def _needs_full_draw(self):
+        if self._full_draw_needed:
+            return True
+        if not getattr(self.figure.canvas, 'supports_blit', False):
+            return True
+        for ax in self.figure.axes:
+            if self._view_states.get(ax) != self._view_state(ax):
+                return True
+        return False
+
+    def on_draw(self, event):
+        """ draw_event callback. Save the backgrounds, which don't include
+            the animated artists, and then draw the animated artists on top. 
+        """
+        canvas = self.figure.canvas
+        self._view_states = dict((ax, self._view_state(ax)) for ax in self.figure.axes)
+        if getattr(canvas, 'supports_blit', False):
+            self._backgrounds = dict((ax, canvas.copy_from_bbox(ax.bbox)) for ax in self._animated)
+        for ax, artists in self._animated.items():
+            for artist in artists:
+                ax.draw_artist(artist)
+        self._full_draw_needed = False
+        self._changed.clear()
+        super(BlittingFigureUpdater, self).on_draw(event)
+
+    def send(self, bounds):
+        if not self.is_visible():
+            return NO_CHANGE
+        self.pull()
+        if self._needs_full_draw():
+            self.figure.canvas.draw()
+            return
+        canvas = self.figure.canvas
+        changed_axes = set(artist.axes for artist in self._changed)
+        self._changed.clear()
+        if not changed_axes:
+            return NO_CHANGE
+        for ax in changed_axes:
+            canvas.restore_region(self._backgrounds[ax])
+            for artist in self._animated[ax]:
+                ax.draw_artist(artist)
+            canvas.blit(ax.bbox)
+
+
 def UpdatesMappable(name):
     """ Name is the attribute to update in the mappable 
         For use in PanelsScatterController instances to update self.mappable_updaters
@@ -41,8 +181,19 @@ class PanelsScatterController(object):
     
     color_field = UpdatesMappable('color_field')
     
-    def __init__(self, panels, color_field='time', default_color_bounds=None, s=4, antialiased=False, **kwargs):
-        """ *panels* is a LinkedPanels instance. extra kwargs are passed to the call to scatter"""
+    def __init__(self, panels, color_field='time', default_color_bounds=None, s=4, antialiased=False, 
+                 depends_on=None, auto_color_range=None, **kwargs):
+        """ *panels* is a LinkedPanels instance. extra kwargs are passed to the call to scatter
+
+            *depends_on* optionally names the variables in panels.bounds that determine which
+            records are sent to the panels, so that a panel is redrawn without comparing the
+            records it was sent when any of them have changed (see ScatterArtistOutlet). It is
+            a sequence used for all panels, or a dict of sequences keyed by axes.
+
+            *auto_color_range* is an optional pair of percentiles, e.g., (1, 99), of the 
+            color field in the data sent to the panels that are used as color limits when
+            the bounds don't limit the color field (see MappableRangeUpdater).
+        """
         
         if default_color_bounds is None:
             default_color_bounds = Bounds()
@@ -51,27 +202,41 @@ class PanelsScatterController(object):
         self.color_field = color_field
         self.panels=panels
         self.artist_outlet_controllers = set()
+        # The outlet for each axes, e.g., for stormdrain.bounds.PanelsBoundsFilter
+        self.panel_outlets = {}
         
         bounds_updated_xchg = get_exchange('SD_bounds_updated')
+        # The panels show the same data, whose sketches are kept once for all of them
+        color_sketches = _BlockSketches()
         artist_outlets = []
         empty = [0,]
-        for ax in panels.ax_specs:
-            # create a new scatter artist
-            art = ax.scatter(empty, empty, c=empty, s=s, edgecolors='none', antialiased=antialiased, **kwargs)
+        # Adding the artists autoscales the axes. Reflow once for all of them.
+        with panels.transaction():
+            for ax in panels.ax_specs:
+                # create a new scatter artist
+                art = ax.scatter(empty, empty, c=empty, s=s, edgecolors='none', antialiased=antialiased, **kwargs)
             
-            # Need to update the color mapping using the specified color field. It needs to know that the
-            # bounds have been updated in order to adjust the color limits.
-            up = MappableRangeUpdater(art, color_field=color_field, default_bounds=default_color_bounds)
-            bounds_updated_xchg.attach(up)
-            self.mappable_updaters.add(up)
+                # Need to update the color mapping using the specified color field. It needs to know that the
+                # bounds have been updated in order to adjust the color limits.
+                up = MappableRangeUpdater(art, color_field=color_field, default_bounds=default_color_bounds,
+                                          auto_range=auto_color_range, sketches=color_sketches)
+                bounds_updated_xchg.attach(up)
+                self.mappable_updaters.add(up)
 
-            # Need to update the actual scatter coordinate data on each scatter artist
-            outlet = ScatterArtistOutlet(art, coord_names=panels.ax_specs[ax], color_field=color_field)
-            self.artist_outlet_controllers.add(outlet)
-            self.mappable_updaters.add(outlet)
+                # Need to update the actual scatter coordinate data on each scatter artist
+                if isinstance(depends_on, dict):
+                    ax_depends_on = depends_on.get(ax, None)
+                else:
+                    ax_depends_on = depends_on
+                outlet = ScatterArtistOutlet(art, coord_names=panels.ax_specs[ax], color_field=color_field,
+                                             bounds=panels.bounds, depends_on=ax_depends_on,
+                                             range_updater=up)
+                self.artist_outlet_controllers.add(outlet)
+                self.mappable_updaters.add(outlet)
 
-            artist_outlets.append(outlet.update())
-            self.artist_outlets=artist_outlets
+                artist_outlets.append(outlet.update())
+                self.panel_outlets[ax] = artist_outlets[-1]
+                self.artist_outlets=artist_outlets
 
         self.branchpoint = Branchpoint(artist_outlets)
         
@@ -116,6 +281,36 @@ class PanelsScatterController(object):
         the_animator = FixedDurationAnimation(figure, duration, pipe_anim, interval=50, repeat=repeat)
         
         return the_animator
+
+    def render(self, duration, fps=20, output='frame_{0:05d}.png', stream=None, 
+               figure=None, processes=None):
+        """ Render the animation that animate() would show to numbered PNG 
+            files (or a raw RGBA stream) offline, across a pool of processes, 
+            without drawing to the GUI canvas. See 
+            stormdrain.support.matplotlib.animation.render_animation_frames
+            for the meaning of the arguments.
+        """
+        if figure is None:
+            figure = self.panels.panels[tuple(self.panels.panels)[0]].figure
+
+        # Grab the current data display with a reflow, as animate does.
+        cache = CachedTriggerableSegment()
+        cache_segment = cache.cache_segment()
+        self.branchpoint.targets.add(cache_segment)
+        try:
+            get_exchange('SD_reflow_start').send("Pre-render data reflow")
+        finally:
+            self.branchpoint.targets.remove(cache_segment)
+        cached = cache.cache.values()
+        if not cached:
+            return []
+
+        artists = [(outlet.artist, outlet.coords, outlet.color_field) 
+                   for outlet in self.artist_outlet_controllers
+                   if outlet.artist.figure is figure]
+        return render_animation_frames(figure, cached[-1], artists, duration, fps,
+                        variable='time', limits=self.panels.bounds.time,
+                        output=output, stream=stream, processes=processes)
         
 
 def scatter_dataset_on_panels(panels, color_field=None):
@@ -159,52 +354,274 @@ class ScatterArtistOutlet(object):
     coord_names is a 2-tuple of names in the array that is sent here that counts as a 
     color_field is the name of the field in a to be used to color the points.
     
+    When the data arrive as a stormdrain.selection.Selection of a versioned dataset,
+    the outlet skips updating the artist (and reporting it as changed, so that it isn't 
+    redrawn by a BlittingFigureUpdater) if the same records were already drawn, i.e., the
+    selected indices are the same. If *bounds* and *depends_on*, a sequence of the bounded
+    variables that determine which records are sent here, are given, the records are known
+    to differ, without comparing the indices, when those limits have changed.
     
+    range_updater is an optional MappableRangeUpdater for the artist, whose automatic
+    color limits are estimated from the data received here (see MappableRangeUpdater.observe).
     """
-    def __init__(self, artist, coord_names=('x', 'y'),  color_field=None):
+    def __init__(self, artist, coord_names=('x', 'y'),  color_field=None, bounds=None, depends_on=None,
+                 range_updater=None):
         self.artist = artist
+        self.range_updater = range_updater
         self.coords = coord_names
         self.color_field = color_field
+        self.bounds = bounds
+        self.depends_on = depends_on
+        self._last_drawn = None
+        self.artist_updated_xchg = get_exchange('MPL_artist_updated')
+
+    @staticmethod
+    def _same_index(index, last_index):
+        if index is last_index:
+            return True
+        if type(index) is not type(last_index):
+            # e.g., a slice and an index array
+            return False
+        if isinstance(index, np.ndarray):
+            return np.array_equal(index, last_index)
+        return index == last_index
+
+    def _same_as_last(self, a):
+        """ True if a is known to be the same records that were last drawn """
+        if (not isinstance(a, Selection)) or (a.version is None):
+            self._last_drawn = None
+            return False
+        if (self.bounds is not None) and (self.depends_on is not None):
+            limits = tuple(self.bounds[v] for v in self.depends_on)
+        else:
+            limits = None
+        last = self._last_drawn
+        self._last_drawn = (a.base, a.version, self.color_field, limits, a.index)
+        if (last is None) or (last[0] is not a.base) or (last[1:4] != (a.version, self.color_field, limits)):
+            return False
+        # Something other than the bounds, e.g., a lasso or an animation, may 
+        # have selected other records.
+        return self._same_index(a.index, last[4])
         
     @coroutine
     def update(self):
         # print "now processing {0}".format(self.artist)
         while True:
             a = (yield)
+            if self._same_as_last(a):
+                continue
 
             # print "artist got data ", a
             ax = self.artist.axes
             coords = self.coords
             # print "artist got coords ", coords
             x, y = a[coords[0]], a[coords[1]]
-            new_scatter_data = np.asarray(list(zip(x,y)))
+            new_scatter_data = np.column_stack((x, y))
             self.artist.set_offsets(new_scatter_data)
             
             if self.color_field is not None:
                 colors = a[self.color_field]
                 self.artist.set_array(colors)
+                if self.range_updater is not None:
+                    self.range_updater.observe(a)
                 # try:
                 #     c_min, c_max = self.ax_bundle.bounds[self.color_field]
                 # except AttributeError:
                 #     c_min, c_max = colors.min(), colors.max()
                 # self.artist.set_clim(c_min, c_max)
                 
-
+            self.artist_updated_xchg.send(self.artist)
             # ax.figure.canvas.draw()
     
+class _BlockSketches(object):
+    """ QuantileSketches of a field in each dataset (the base array of a versioned
+        Selection), kept as a tree: each block of block_size consecutive records
+        is sketched the first time any of its records are shown, and each run of
+        blocks is the merge of the two halves of the run. The sketch for some of 
+        the records is the merge of the few runs that cover the blocks that hold
+        them. Plain arrays are sketched from at most about sample_size of their 
+        values, evenly spaced.
+    """
+    def __init__(self, block_size=65536, sample_size=65536):
+        self.block_size = block_size
+        self.sample_size = sample_size
+        # (id(base), field) -> (weak reference to base, version, {(first, stop block):sketch})
+        self._trees = {}
+
+    def _forget(self, key):
+        def forget(ref):
+            entry = self._trees.get(key)
+            if (entry is not None) and (entry[0] is ref):
+                del self._trees[key]
+        return forget
+
+    def _blocks(self, a):
+        """ Sorted array of the blocks that hold the records selected by a """
+        size = self.block_size
+        if isinstance(a.index, slice):
+            start, stop, step = a.index.indices(len(a.base))
+            count = len(range(start, stop, step))
+            if count == 0:
+                return np.empty(0, dtype=int)
+            first, last = sorted((start, start + (count-1)*step))
+            return np.arange(first//size, last//size + 1)
+        n_blocks = (len(a.base) + size - 1)//size
+        index = np.asarray(a.index)
+        return np.flatnonzero(np.bincount(index//size, minlength=n_blocks))
+
+    def _run(self, tree, values, lo, hi):
+        """ Sketch of the blocks lo to hi-1, a node of the tree """
+        sketch = tree.get((lo, hi))
+        if sketch is None:
+            if hi - lo == 1:
+                sketch = QuantileSketch().update(values[lo*self.block_size:hi*self.block_size])
+            else:
+                mid = (lo + hi)//2
+                sketch = self._run(tree, values, lo, mid).copy().merge(self._run(tree, values, mid, hi))
+            tree[(lo, hi)] = sketch
+        return sketch
+
+    def _cover(self, tree, values, lo, hi, first, stop, runs):
+        """ Append to runs the nodes under (lo, hi) that cover blocks first to stop-1 """
+        if (stop <= lo) or (hi <= first):
+            return
+        if (first <= lo) and (hi <= stop):
+            runs.append(self._run(tree, values, lo, hi))
+            return
+        mid = (lo + hi)//2
+        self._cover(tree, values, lo, mid, first, stop, runs)
+        self._cover(tree, values, mid, hi, first, stop, runs)
+
+    def sketch(self, a, field):
+        """ A sketch of field in the blocks of records that hold the records
+            selected by a, which is not changed later.
+        """
+        if not (isinstance(a, Selection) and (a.version is not None)):
+            values = np.asarray(a[field])
+            if len(values) > self.sample_size:
+                values = values[::len(values)//self.sample_size]
+            return QuantileSketch().update(values)
+        key = (id(a.base), field)
+        entry = self._trees.get(key)
+        if (entry is None) or (entry[0]() is not a.base) or (entry[1] != a.version):
+            entry = (weakref.ref(a.base, self._forget(key)), a.version, {})
+            self._trees[key] = entry
+        tree, values = entry[2], a.base[field]
+        n_blocks = (len(a.base) + self.block_size - 1)//self.block_size
+        blocks = self._blocks(a)
+        runs = []
+        if len(blocks) > 0:
+            for run in np.split(blocks, np.flatnonzero(np.diff(blocks) > 1) + 1):
+                self._cover(tree, values, 0, n_blocks, run[0], run[-1] + 1, runs)
+        if len(runs) == 1:
+            return runs[0]
+        sketch = QuantileSketch()
+        for run in runs:
+            sketch.merge(run)
+        return sketch
+
+
 class MappableRangeUpdater(object):
-    def __init__(self, artist, color_field, default_bounds=None):
+    """ Sets the color limits of artist to the range of color_field in the bounds
+        sent on SD_bounds_updated, or in default_bounds if the bounds don't limit 
+        color_field.
+
+        If auto_range is a pair of percentiles, such as (1, 99), limits that are in
+        neither come instead from a stormdrain.sketch.QuantileSketch of the values of 
+        color_field, once there are any. The values are those of the blocks of 
+        records that hold the records the artist's outlet has shown (see observe),
+        or, if sketch is given, those that sketch is updated with elsewhere, e.g., 
+        by a SketchingSegment that sees the records appended to a live dataset.
+
+        The sketches of each block are kept by sketches, which can be shared by
+        the updaters of artists that show the same data, as PanelsScatterController
+        does.
+    """
+    exchange_priority = PRIORITY_STYLE
+
+    def __init__(self, artist, color_field, default_bounds=None, auto_range=None, sketch=None,
+                 sketches=None):
         self.color_field = color_field
         self.artist = artist
         self.default_bounds = default_bounds
         if self.default_bounds is None:
             self.default_bounds = Bounds()
-        
+        self.auto_range = auto_range
+        self.sketch = sketch
+        self.sketches = sketches
+        if self.sketches is None:
+            self.sketches = _BlockSketches()
+        self._limited = True
+        # id(base) -> (weak reference to base, color_field, sketch)
+        self._sources = {}
+        self._unversioned = None
+
+    def _forget(self, key):
+        def forget(ref):
+            entry = self._sources.get(key)
+            if (entry is not None) and (entry[0] is ref):
+                del self._sources[key]
+        return forget
+
+    def observe(self, a):
+        """ Find the sketch of color_field in the records a that are shown by the 
+            artist, and update the color limits if they are automatic.
+
+            The sketch of the records shown from each dataset, i.e., the base array 
+            of a versioned Selection, replaces the one last shown from it, and the 
+            sketches of each dataset are merged, so datasets that arrive in chunks
+            are each sketched separately. The blocks of a dataset are only sketched
+            once for each version of it (see _BlockSketches). A plain array replaces
+            the last one.
+        """
+        if (self.auto_range is None) or (self.color_field is None):
+            return
+        if self.sketch is None:
+            sketch = self.sketches.sketch(a, self.color_field)
+            if isinstance(a, Selection) and (a.version is not None):
+                key = id(a.base)
+                self._sources[key] = (weakref.ref(a.base, self._forget(key)), self.color_field, sketch)
+            else:
+                self._unversioned = (self.color_field, sketch)
+        if not self._limited:
+            self._set_clim(self.auto_limits())
+
+    def auto_limits(self):
+        """ Color limits at the auto_range percentiles, or None if no values have
+            been sketched.
+        """
+        sketch = self.sketch
+        if sketch is None:
+            sketches = [source_sketch for ref, color_field, source_sketch in list(self._sources.values())
+                        if (ref() is not None) and (color_field == self.color_field)]
+            if (self._unversioned is not None) and (self._unversioned[0] == self.color_field):
+                sketches.append(self._unversioned[1])
+            if len(sketches) == 1:
+                sketch = sketches[0]
+            else:
+                sketch = QuantileSketch()
+                for source_sketch in sketches:
+                    sketch.merge(source_sketch)
+        if len(sketch) == 0:
+            return None
+        lo, hi = sketch.quantiles(np.asarray(self.auto_range, dtype=float)/100.0)
+        return float(lo), float(hi)
+
+    def _set_clim(self, lim):
+        if (lim is None) or (tuple(lim) == self.artist.get_clim()):
+            return NO_CHANGE
+        self.artist.set_clim(lim[0], lim[1])
+
     def send(self, bounds):
         lim = bounds[self.color_field]
-        if (lim[0] is None) and (lim[1] is None):
-            lim = self.default_bounds[self.color_field]
-        self.artist.set_clim(lim[0], lim[1])
+        self._limited = not ((lim[0] is None) and (lim[1] is None))
+        if not self._limited:
+            lim = None
+            if self.auto_range is not None:
+                lim = self.auto_limits()
+            if lim is None:
+                lim = self.default_bounds[self.color_field]
+        return self._set_clim(lim)
     
 
 class LineArtistOutlet(object):
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 import datetime
+from collections import OrderedDict
 
 import numpy as np
 from matplotlib.ticker import Formatter, EngFormatter
@@ -8,32 +9,26 @@ from matplotlib.dates import AutoDateFormatter
 
 
 class SecDayFormatter(Formatter):
+    """ Formats seconds of the day to HHMM:SS.SSS
+
+        Labels are remembered for the cache_size most recent combinations of
+        tick value, label format and reference date, since the same ticks are
+        labeled on each draw of each time axis.
+    """
     
-    def __init__(self, base_date, axis):
+    def __init__(self, base_date, axis, cache_size=256):
         self.reference_date = base_date
         self._axis = axis
+        self.cache_size = cache_size
+        self._labels = OrderedDict()
 
-    def __call__(self, x, pos=None):
-        """ Formats seconds of the day to HHMM:SS.SSS
-            Maximum resolution is 1 microsecond, due to limitiation in datetime
-        """
-        
-        ref_date = self.reference_date
-        tick_date = ref_date + datetime.timedelta(0, x)
-        
-        interval = self._axis.get_view_interval()
-        delta_sec = interval[1] - interval[0]
-        
+    def _formats(self, delta_sec):
+        """ fmt and frac_fmt for ticks on an axis spanning delta_sec """
         if (delta_sec < 30):
             fmt = '%S'
         else:
             fmt = '%H%M:%S'
         
-        # for most plots, it seems like pos=1 is the first label, even though pos=0 is also requested.
-        # some plots do in fact plot the label for both pos=0 and pos=1, so go with 1 for safety
-        if pos == 1:
-            fmt = '%H%M:%S'
-        
         # This could be generated algorithmically - the pattern is obvious.
         frac_fmt = '%.6f'
         if delta_sec > 0.00005:
@@ -48,18 +43,50 @@ class SecDayFormatter(Formatter):
             frac_fmt = '%.1f'
         if delta_sec > 5:
             frac_fmt = '%.0f'
-            
+        return fmt, frac_fmt
+
+    def _label(self, x, fmt, frac_fmt):
+        key = (x, fmt, frac_fmt, self.reference_date)
+        label = self._labels.pop(key, None)
+        if label is None:
+            tick_date = self.reference_date + datetime.timedelta(0, x)
+            time_str = tick_date.strftime(fmt)
+            frac_str = frac_fmt % (tick_date.microsecond/1.0e6)
+            label = time_str + frac_str[1:]
+            if len(self._labels) >= self.cache_size:
+                self._labels.popitem(last=False)
+        self._labels[key] = label
+        return label
+
+    def _tick_format(self, pos, fmt, frac_fmt):
+        # for most plots, it seems like pos=1 is the first label, even though pos=0 is also requested.
+        # some plots do in fact plot the label for both pos=0 and pos=1, so go with 1 for safety
+        if pos == 1:
+            fmt = '%H%M:%S'
         if pos is None:
             # Be verbose for the status readout
             fmt = '%H%M:%S'
             frac_fmt = '%.6f'
-        
-        # if pos is not None:
-        #     print x, delta_sec, frac_fmt, frac_fmt % (tick_date.microsecond/1.0e6)
-        
-        time_str = tick_date.strftime(fmt)
-        frac_str = frac_fmt % (tick_date.microsecond/1.0e6)
-        return time_str + frac_str[1:]
+        return fmt, frac_fmt
+
+    def __call__(self, x, pos=None):
+        """ Formats seconds of the day to HHMM:SS.SSS
+            Maximum resolution is 1 microsecond, due to limitiation in datetime
+        """
+        interval = self._axis.get_view_interval()
+        fmt, frac_fmt = self._formats(interval[1] - interval[0])
+        fmt, frac_fmt = self._tick_format(pos, fmt, frac_fmt)
+        return self._label(x, fmt, frac_fmt)
+
+    def format_ticks(self, values):
+        """ Labels for all ticks at once, with the format for the view 
+            interval found only once.
+        """
+        self.set_locs(values)
+        interval = self._axis.get_view_interval()
+        fmt, frac_fmt = self._formats(interval[1] - interval[0])
+        return [self._label(x, *self._tick_format(pos, fmt, frac_fmt)) 
+                for pos, x in enumerate(values)]
             
 
 
@@ -1,7 +1,10 @@
 from __future__ import absolute_import
 from collections import defaultdict
+from contextlib import contextmanager
 
 from stormdrain.bounds import Bounds
+from stormdrain.cache import ByteBudgetCache
+from stormdrain.pipeline import coroutine
 from stormdrain.pubsub import get_exchange
 from .mplevents import MPLaxesManager
 import six
@@ -9,6 +12,124 @@ from six.moves import range
 
 
 
+class ViewHistory(object):
+    """ Remembers what was sent to the targets of some Branchpoints for each 
+        of the most recent views (states of bounds), so that a view can be 
+        shown again without reflowing the data through the pipeline.
+
+        history = ViewHistory(panels.bounds, max_bytes=100e6)
+        history.wrap(scatter_ctrl.branchpoint)
+        panels.history = history
+
+        Wrap the branchpoints just upstream of the outlets, so that replay
+        skips as much of the pipeline as possible. If data are sent as 
+        Selections (see NamedArrayDataset), what is remembered for each view 
+        is just an index into the data. Views are forgotten, oldest first, 
+        once they take up more than max_bytes or number more than max_views.
+        
+        When a new version of the data arrives, all views are forgotten. If the
+        datasets are given, views recorded from another version of those 
+        datasets are also never replayed.
+
+        A replayed view is not reflowed: SD_replay_reflow_start is sent in place
+        of SD_reflow_start, so only the subscribers that opt in to it reflow, 
+        e.g., datasets whose pipelines aren't wrapped (see reflow_on_replay).
+    """
+    def __init__(self, bounds, max_bytes=None, max_views=32, datasets=()):
+        self.bounds = bounds
+        self.datasets = list(datasets)
+        self.cache = ByteBudgetCache(max_bytes=max_bytes, max_items=max_views)
+        self.recorders = []
+        self._data_versions = {}
+
+    def key(self, bounds=None):
+        if bounds is None:
+            bounds = self.bounds
+        return tuple(sorted(bounds.to_dict().items()))
+
+    def _dataset_state(self):
+        return tuple((id(ds.data), ds.version) for ds in self.datasets)
+
+    def wrap(self, branchpoint):
+        """ Record everything branchpoint sends to its current targets """
+        branchpoint.targets = set(self.record(target) for target in branchpoint.targets)
+
+    def reflow_on_replay(self, dataset):
+        """ Reflow dataset, e.g., a NamedArrayDataset, or any other subscriber 
+            of SD_reflow_start that isn't covered by this history, also when a 
+            view is replayed.
+        """
+        get_exchange('SD_replay_reflow_start').attach(dataset)
+
+    def record(self, target):
+        """ Returns a coroutine that remembers what it receives for the 
+            current view, and then sends it on to target.
+        """
+        recorder = self._recorder(target)
+        self.recorders.append(recorder)
+        return recorder
+
+    @coroutine
+    def _recorder(self, target):
+        while True:
+            a = (yield)
+            self._check_version(target, a)
+            key = self.key()
+            entry = self.cache.get(key)
+            if (entry is None) or (entry[0] != self._dataset_state()):
+                entry = (self._dataset_state(), {})
+            entry[1][target] = a
+            # Stored again to count its new size
+            self.cache.put(key, entry)
+            target.send(a)
+
+    def _check_version(self, target, a):
+        if getattr(a, 'version', None) is None:
+            return
+        data_version = (id(a.base), a.version)
+        if self._data_versions.get(target, data_version) != data_version:
+            self.invalidate()
+        self._data_versions[target] = data_version
+
+    def invalidate(self):
+        """ Forget all views """
+        self.cache.clear()
+        self._data_versions.clear()
+
+    def replay(self, bounds=None):
+        """ Send the data remembered for bounds (by default, the current 
+            bounds) to the targets. Returns False, doing nothing, if that 
+            view wasn't recorded for all targets.
+        """
+        entry = self.cache.get(self.key(bounds))
+        if (entry is None) or (entry[0] != self._dataset_state()):
+            return False
+        payloads = entry[1]
+        if len(payloads) < len(self.recorders):
+            return False
+        for target, a in payloads.items():
+            target.send(a)
+        return True
+
+
+class _PreviewFollower(object):
+    """ Receives MPL_interaction_preview messages on behalf of a LinkedPanels """
+    def __init__(self, panels):
+        self.panels = panels
+
+    def send(self, ax_mgr):
+        self.panels.preview(ax_mgr)
+
+
+class _RemoteBoundsFollower(object):
+    """ Receives SD_remote_bounds_updated messages on behalf of a LinkedPanels """
+    def __init__(self, panels):
+        self.panels = panels
+
+    def send(self, bounds):
+        self.panels.follow_bounds(bounds)
+
+
 class LinkedPanels(object):
     """ Helper class to manage updates of linked axes.
     
@@ -24,6 +145,18 @@ class LinkedPanels(object):
         on another horizontal axis.
         
         This class is figure-agnostic, so it can handle a set of axes linked across figures.
+
+        If debounce_ms is given, an interaction with the axes is taken to be
+        complete once their limits have not changed for that long (see 
+        mplevents.DebouncedAccumulator). While the interaction continues, the
+        limits of the linked axes follow along without reflowing the data.
+
+        To change several limits at once with only one reflow of the data,
+        use set_limits, or make the changes within a transaction():
+
+        with panels.transaction():
+            panels.panels['xy'].axis((-110, -90, 30, 40))
+            panels.panels['tz'].axis((0, 10, 0, 5e3))
     """
 
     # margin_defaults = {
@@ -34,10 +167,15 @@ class LinkedPanels(object):
     #         # 't': (0.1, 0.85, 0.8, 0.1),
     #         }        
     #     
-    def __init__(self, ax_specs):
+    def __init__(self, ax_specs, debounce_ms=None):
+        self.debounce_ms = debounce_ms
         # self.figure = figure
         # self.panels = {}
         self._D = 2 # dimension of the axes
+        # A ViewHistory, to replay views that were already seen
+        self.history = None
+        self._transaction_depth = 0
+        self._transaction_changed = False
         self._setup_events()
         
         self.axes_managers = {}
@@ -56,24 +194,121 @@ class LinkedPanels(object):
         assert len(names) == self._D
         for d in range(self._D):
             self.ax_coords[names[d]].add(ax)
-            self.axes_managers[names] = MPLaxesManager(ax)
+        self.axes_managers[names] = MPLaxesManager(ax, debounce_ms=self.debounce_ms)
         
     def _setup_events(self):
         self.interaction_xchg = get_exchange('MPL_interaction_complete')
         self.interaction_xchg.attach(self)
+        if self.debounce_ms is not None:
+            self.preview_follower = _PreviewFollower(self)
+            get_exchange('MPL_interaction_preview').attach(self.preview_follower)
         self.bounds_updated_xchg = get_exchange('SD_bounds_updated') 
         self.reflow_start_xchg = get_exchange('SD_reflow_start')
+        self.replay_reflow_start_xchg = get_exchange('SD_replay_reflow_start')
         self.reflow_done_xchg = get_exchange('SD_reflow_done')
+        # Bounds from linked panels in another process; see stormdrain.relay
+        self.remote_follower = _RemoteBoundsFollower(self)
+        get_exchange('SD_remote_bounds_updated').attach(self.remote_follower)
             
     def reset_axes_events(self):
         for mgr in self.axes_managers.values():
             mgr.events.reset()
             
+    @contextmanager
+    def transaction(self):
+        """ Within the block, limit changes update bounds, but the reflow 
+            they would trigger is done once, at the end of the block.
+        """
+        self._transaction_depth += 1
+        try:
+            with self.bounds.transaction():
+                yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                # Don't reflow a batch of changes that failed part way
+                self._transaction_changed = False
+            raise
+        self._transaction_depth -= 1
+        if (self._transaction_depth == 0) and self._transaction_changed:
+            self._transaction_changed = False
+            self.bounds_updated()
+
+    def _set_bounds(self, limits):
+        """ Set bounds from {name:(v_min, v_max)} for the coordinates shown
+            on these axes. Returns the set of axes that need new limits.
+        """
+        axes_to_update = set()
+        for name, lim in limits:
+            if (name in self.ax_coords) and (tuple(lim) != tuple(getattr(self.bounds, name))):
+                setattr(self.bounds, name, tuple(lim))
+                axes_to_update.update(self.ax_coords[name])
+        return axes_to_update
+
+    def _apply_limits(self, axes_to_update):
+        """ Set the limits of axes_to_update from bounds. Autoscaling that is
+            still pending (e.g., for a new scatter artist) would replace the
+            limits when they are next read, so it is turned off.
+        """
+        for ax in axes_to_update:
+            these_coords = self.ax_specs[ax]
+            ax.set_autoscale_on(False)
+            ax.set_xlim(getattr(self.bounds, these_coords[0]), emit=False)
+            ax.set_ylim(getattr(self.bounds, these_coords[1]), emit=False)
+        for ax in axes_to_update:
+            self.axes_managers[self.ax_specs[ax]].events.reset()
+
+    def set_limits(self, **limits):
+        """ Set the limits of coordinates, e.g., 
+                set_limits(lon=(-110, -90), lat=(30, 40), time=(0, 10))
+            on all axes that show them, followed by one reflow.
+        """
+        with self.transaction():
+            axes_to_update = self._set_bounds(limits.items())
+            self._apply_limits(axes_to_update)
+            if axes_to_update:
+                self._transaction_changed = True
+
     def bounds_updated(self):
+        if self._transaction_depth > 0:
+            self._transaction_changed = True
+            return
         self.bounds_updated_xchg.send(self.bounds)
-        self.reflow_start_xchg.send('LinkedPanels triggered data reflow')
+        if (self.history is not None) and self.history.replay(self.bounds):
+            # Only what the history doesn't cover is reflowed
+            self.replay_reflow_start_xchg.send('LinkedPanels replayed a view')
+        else:
+            self.reflow_start_xchg.send('LinkedPanels triggered data reflow')
         self.reflow_done_xchg.send('LinkedPanels reflow done')
 
+    def follow_bounds(self, bounds):
+        """ Adopt the limits in bounds for any coordinates shown on these
+            axes, without triggering a reflow, which is expected to be relayed
+            from wherever the bounds came from.
+        """
+        axes_to_update = self._set_bounds(bounds.limits())
+        if not axes_to_update:
+            return
+        self._apply_limits(axes_to_update)
+        self.bounds_updated_xchg.send(self.bounds)
+
+    def preview(self, ax_mgr):
+        """ Move the limits of the axes linked to ax_mgr.axes along with it,
+            but leave bounds (and the data) alone until the interaction is
+            complete.
+        """
+        axes = ax_mgr.axes
+        if axes not in self.ax_specs:
+            return
+        limits = dict(zip(self.ax_specs[axes], (axes.get_xlim(), axes.get_ylim())))
+        for ax, (x_var, y_var) in self.ax_specs.items():
+            if ax is axes:
+                continue
+            if x_var in limits:
+                ax.set_xlim(limits[x_var], emit=False)
+            if y_var in limits:
+                ax.set_ylim(limits[y_var], emit=False)
+
     def send(self, ax_mgr):
         """ MPL_interaction_complete messages are sent here """
         bounds = self.bounds
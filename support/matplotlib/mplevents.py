@@ -4,6 +4,8 @@ from stormdrain.pubsub import get_exchange
 # Names of recognized exchanges and a simple description of what they do.
 MPL_exchanges = {
     'MPL_interaction_complete':"Plot limits have changed by user interaction and/or programmatic limit set. Message sent is MPLaxesManager instance",
+    'MPL_artist_updated':"An outlet has changed the data shown by an artist. Message sent is the artist",
+    'MPL_interaction_preview':"Plot limits are changing during an interaction that has not completed. Message sent is MPLaxesManager instance",
     }
 
 
@@ -101,12 +103,101 @@ class Accumulator(object):
             self.reset()
 
 
+class DebouncedAccumulator(Accumulator):
+    """ Calls func(axes) once the axis limits have stopped changing for 
+        quiet_ms milliseconds, and the mouse is up, instead of counting limit
+        changes and draws. A scroll-wheel zoom or toolbar pan, which change 
+        the limits many times, result in one call.
+
+        func is only called if the limits differ from those at the last call,
+        or at the last reset (e.g., after LinkedPanels set them), by more than
+        tolerance times the width of the axes. axes are the axes whose limits
+        are watched, if known, so that they can be remembered on reset.
+
+        If preview is given, preview(axes) is called for each limit change 
+        during the interaction.
+
+        The timer is made by canvas.new_timer, so the backend's event loop
+        must be running.
+    """
+    def __init__(self, func, canvas, quiet_ms=150, tolerance=1e-6, preview=None, axes=None):
+        self.tolerance = tolerance
+        self.preview = preview
+        self.watched_axes = axes
+        self._last_limits = {}
+        self._timer = canvas.new_timer(interval=quiet_ms)
+        self._timer.single_shot = True
+        self._timer.add_callback(self.quiet)
+        super(DebouncedAccumulator, self).__init__(func)
+
+    def axis_limit_changed(self, ax):
+        self.limits_changed += 1
+        self.axes = ax
+        if self.preview is not None:
+            self.preview(ax)
+        self._restart()
+
+    def draw_event(self, event):
+        pass
+
+    def mouse_down_event(self, event):
+        self.mouse_up = False
+        self._timer.stop()
+
+    def mouse_up_event(self, event):
+        self.mouse_up = True
+        if self.limits_changed > 0:
+            self._restart()
+
+    def reset(self):
+        super(DebouncedAccumulator, self).reset()
+        if self.watched_axes is not None:
+            self._last_limits[self.watched_axes] = self._limits(self.watched_axes)
+
+    @staticmethod
+    def _limits(ax):
+        return tuple(ax.get_xlim()) + tuple(ax.get_ylim())
+
+    def _restart(self):
+        self._timer.stop()
+        self._timer.start()
+
+    def limits_really_changed(self, ax):
+        limits = self._limits(ax)
+        last = self._last_limits.get(ax)
+        if last is None:
+            return True
+        x_tol = self.tolerance*abs(limits[1] - limits[0])
+        y_tol = self.tolerance*abs(limits[3] - limits[2])
+        tols = (x_tol, x_tol, y_tol, y_tol)
+        return any(abs(new - old) > tol for new, old, tol in zip(limits, last, tols))
+
+    def quiet(self):
+        """ Timer callback, after quiet_ms without a limit change """
+        if (not self.mouse_up) or (self.limits_changed == 0):
+            return
+        ax = self.axes
+        if self.limits_really_changed(ax):
+            self._last_limits[ax] = self._limits(ax)
+            self.func(ax)
+        self.reset()
+
+
 class MPLaxesManager(object):
 
-    def __init__(self, axes): #coordinate_names
+    def __init__(self, axes, debounce_ms=None): #coordinate_names
+        """ If debounce_ms is given, interactions are complete once the limits
+            have not changed for that long; see DebouncedAccumulator. Then,
+            MPL_interaction_preview is sent during the interaction.
+        """
         self.axes   = axes
         # self.coordinate_names = coordinate_names
-        self.events = Accumulator(self.on_axes_changed)        
+        if debounce_ms is None:
+            self.events = Accumulator(self.on_axes_changed)        
+        else:
+            self.events = DebouncedAccumulator(self.on_axes_changed, self.axes.figure.canvas, 
+                                               quiet_ms=debounce_ms, preview=self.on_axes_changing,
+                                               axes=self.axes)
         
         self.callback_ids = {}
         self.callback_ids['draw_event'] = self.axes.figure.canvas.mpl_connect('draw_event', self.events.draw_event)
@@ -125,4 +216,9 @@ class MPLaxesManager(object):
             
         get_exchange('MPL_interaction_complete').send(self)
 
+    def on_axes_changing(self, axes):
+        if axes != self.axes:
+            return
+        get_exchange('MPL_interaction_preview').send(self)
+
         
\ No newline at end of file
@@ -6,6 +6,8 @@ from matplotlib import path
 
 from stormdrain.pubsub import get_exchange
 from stormdrain.pipeline import Segment, coroutine, CachedTriggerableSegment
+from stormdrain.selection import select
+from stormdrain.kernels import points_in_polygon
 from six.moves import zip
 
 
@@ -25,10 +27,7 @@ class LassoFilter(Segment):
     def filter_mask(self, a):
         coord0 = self.coord_names[0]
         coord1 = self.coord_names[1]
-        p = path.Path(self.verts)
-        xys = list(zip(a[coord0], a[coord1]))
-        in_poly_mask = p.contains_points(xys) == 1
-        return in_poly_mask
+        return points_in_polygon(a[coord0], a[coord1], self.verts)
     
     @coroutine
     def filter(self):
@@ -37,7 +36,7 @@ class LassoFilter(Segment):
             a = (yield)
             # good = np.ones(a.shape, dtype=bool)
             in_poly_mask = self.filter_mask(a)           
-            self.target.send(a[in_poly_mask])
+            self.target.send(select(a, in_poly_mask))
 
 
 class PolyLasso(Widget):
@@ -231,13 +230,20 @@ class LassoPayloadController(object):
 
             On receiving a new lasso, trigger a resend of the cached data 
             to the dataset modifier.
+
+            If the kwarg cache_base is a NamedArrayDataset that sends its data
+            as Selections (selections=True), the cache holds only the indices 
+            of the current plot state into the dataset, instead of a copy of
+            the records.
         """
         self.target = kwargs.pop('target', None)
+        cache_base = kwargs.pop('cache_base', None)
         self._payload = None
         self.lasso_filter = LassoFilter(target=self.add_payload_value(target=self.target))
         self.lasso_xchg = get_exchange('B4D_panel_lasso_drawn')
         self.lasso_xchg.attach(self)
-        self.cache_segment = CachedTriggerableSegment(target=self.lasso_filter.filter())
+        self.cache_segment = CachedTriggerableSegment(target=self.lasso_filter.filter(),
+                                base=cache_base)
 
     @coroutine
     def add_payload_value(self, target=None):
@@ -0,0 +1,290 @@
+""" Record the interactions with a set of LinkedPanels, and replay them later,
+    e.g., headlessly with the Agg backend, to profile a pipeline against the
+    way it is actually used.
+
+    with InteractionRecorder(panels, 'session.jsonl.gz'):
+        plt.show()
+
+    Later, with the same kind of panels, data and pipeline:
+
+    replayer = InteractionReplayer(panels, 'session.jsonl.gz')
+    results = replayer.replay()
+    print(summarize(results))
+
+    The file has one JSON object per line, gzipped if the filename ends in
+    .gz. After a header, each line is a message sent on one of the recorded
+    exchanges, with the seconds since recording started, t:
+
+    {"t": 2.01, "exchange": "MPL_interaction_complete", "axes": ["lon", "lat"],
+     "limits": [-103.0, -100.0, 32.0, 35.0]}
+    {"t": 2.01, "exchange": "SD_bounds_updated", "bounds": {"lon": [-103.0, -100.0], ...}}
+    {"t": 2.32, "exchange": "SD_reflow_done"}
+    {"t": 9.8, "exchange": "B4D_panel_lasso_drawn", "axes": ["lon", "lat"],
+     "verts": [[-102.1, 33.0], ...]}
+
+    Axes are identified by the names of their coordinates in panels.ax_specs.
+"""
+from __future__ import absolute_import
+import gzip
+import json
+import time
+
+import numpy as np
+
+from stormdrain.pubsub import get_exchange, NO_CHANGE, PRIORITY_DATA, PRIORITY_DRAW
+
+_format = 'stormdrain.interactions'
+
+default_names = ('MPL_interaction_complete', 'SD_bounds_updated', 'B4D_panel_lasso_drawn',
+                 'SD_reflow_done')
+
+# Messages that are replayed, in response to which the rest are sent again
+replayed_names = ('MPL_interaction_complete', 'SD_bounds_updated', 'B4D_panel_lasso_drawn')
+
+
+def replayable(records):
+    """ The records that are replayed. Bounds that were updated in response to
+        the interaction recorded just before them are left out, since they are
+        updated again when it is replayed.
+    """
+    previous = None
+    for record in records:
+        name = record['exchange']
+        if (name in replayed_names) and not ((name == 'SD_bounds_updated') and 
+                (previous == 'MPL_interaction_complete')):
+            yield record
+        previous = name
+
+def _open(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 'b')
+    return open(filename, mode + 'b')
+
+def read_interactions(filename):
+    """ The header and list of records in a file written by InteractionRecorder """
+    with _open(filename, 'r') as f:
+        lines = [json.loads(line.decode('utf-8')) for line in f if line.strip()]
+    if (not lines) or (lines[0].get('format') != _format):
+        raise ValueError("{0} is not a recording of stormdrain interactions".format(filename))
+    return lines[0], lines[1:]
+
+
+class _Recorder(object):
+    """ Subscribes to one exchange on behalf of an InteractionRecorder """
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def send(self, msg):
+        self.recorder.record(self.name, msg)
+        return NO_CHANGE
+
+
+class InteractionRecorder(object):
+    """ Writes the messages sent on the exchanges names that concern panels,
+        a LinkedPanels, to filename, until closed.
+    """
+    def __init__(self, panels, filename, names=default_names):
+        self.panels = panels
+        self.filename = filename
+        self.names = tuple(names)
+        self.file = _open(filename, 'w')
+        self.count = 0
+        self._write({'format':_format, 'version':1, 'exchanges':list(self.names),
+                     'axes':sorted(list(names) for names in panels.ax_specs.values()),
+                     'bounds':panels.bounds.to_dict(),
+                     'started':time.strftime('%Y-%m-%dT%H:%M:%S')})
+        self.t0 = time.time()
+        self.recorders = []
+        for name in self.names:
+            recorder = _Recorder(self, name)
+            if name == 'SD_reflow_done':
+                # Record the end of a reflow once the figures are drawn
+                priority = PRIORITY_DRAW + 1
+            else:
+                # Record messages before they are handled, so that the messages 
+                # sent in response come later.
+                priority = PRIORITY_DATA - 1
+            get_exchange(name).attach(recorder, priority=priority)
+            self.recorders.append(recorder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for recorder in self.recorders:
+            get_exchange(recorder.name).detach(recorder)
+        self.recorders = []
+        self.file.close()
+
+    def _write(self, record):
+        self.file.write((json.dumps(record) + '\n').encode('utf-8'))
+
+    def _axes_names(self, ax):
+        names = self.panels.ax_specs.get(ax)
+        if names is not None:
+            return list(names)
+
+    def encode(self, name, msg):
+        """ The record of msg sent on the exchange name, or None to skip it """
+        record = {'exchange':name}
+        if name == 'MPL_interaction_complete':
+            record['axes'] = self._axes_names(msg.axes)
+            if record['axes'] is None:
+                return None
+            limits = msg.axes.get_xlim() + msg.axes.get_ylim()
+            bounds = self.panels.bounds
+            if limits == (getattr(bounds, record['axes'][0]) + getattr(bounds, record['axes'][1])):
+                # Nothing to do, e.g., linked axes that follow the interaction
+                return None
+            record['limits'] = [float(v) for v in limits]
+        elif name == 'SD_bounds_updated':
+            if msg is not self.panels.bounds:
+                return None
+            record['bounds'] = msg.to_dict()
+        elif name == 'B4D_panel_lasso_drawn':
+            panels, ax, lasso_line, verts = msg
+            if panels is not self.panels:
+                return None
+            record['axes'] = self._axes_names(ax)
+            record['verts'] = np.asarray(verts, dtype=float).tolist()
+        return record
+
+    def record(self, name, msg):
+        t = time.time() - self.t0
+        record = self.encode(name, msg)
+        if record is None:
+            return
+        record['t'] = round(t, 6)
+        self._write(record)
+        self.count += 1
+
+
+class _ReflowCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def send(self, msg):
+        self.count += 1
+        return NO_CHANGE
+
+
+class InteractionReplayer(object):
+    """ Replays the records in filename (or the list records, after header)
+        with panels, a LinkedPanels that shows the same coordinates as the 
+        recorded panels.
+
+        User interactions with the axes are replayed by setting the recorded
+        limits, and sending MPL_interaction_complete for the axes, as their
+        MPLaxesManager would. Bounds are set with panels.set_limits, or if 
+        they are unchanged, sent again with panels.bounds_updated. Lassos are
+        sent on B4D_panel_lasso_drawn. See replayable for the records that are
+        replayed.
+    """
+    def __init__(self, panels, filename=None, records=None, header=None):
+        self.panels = panels
+        if records is None:
+            header, records = read_interactions(filename)
+        self.header = header
+        self.records = records
+
+    def restore(self):
+        """ Set the bounds that panels had when recording started """
+        if (self.header is not None) and self.header.get('bounds'):
+            self.panels.set_limits(**dict((k, tuple(lim)) 
+                                          for k, lim in self.header['bounds'].items()))
+
+    def _axes(self, names):
+        names = tuple(names)
+        for ax, ax_names in self.panels.ax_specs.items():
+            if tuple(ax_names) == names:
+                return ax
+        raise KeyError("No axes for {0} in panels".format(names))
+
+    def apply(self, record):
+        """ Replay one record. Returns False if it is not replayable """
+        name = record['exchange']
+        if name == 'MPL_interaction_complete':
+            ax = self._axes(record['axes'])
+            x0, x1, y0, y1 = record['limits']
+            ax.set_xlim(x0, x1, emit=False)
+            ax.set_ylim(y0, y1, emit=False)
+            get_exchange(name).send(self.panels.axes_managers[tuple(record['axes'])])
+        elif name == 'SD_bounds_updated':
+            version = self.panels.bounds.version
+            self.panels.set_limits(**dict((k, tuple(lim)) for k, lim in record['bounds'].items()))
+            if self.panels.bounds.version == version:
+                # The same bounds were sent again, to redraw
+                self.panels.bounds_updated()
+        elif name == 'B4D_panel_lasso_drawn':
+            ax = self._axes(record['axes'])
+            get_exchange(name).send((self.panels, ax, None, record['verts']))
+        else:
+            return False
+        return True
+
+    def replay(self, realtime=False, speed=1.0):
+        """ Replay the records in order, as fast as possible, or if realtime,
+            with the recorded time between them divided by speed. Returns a
+            list of {'t', 'exchange', 'seconds', 'reflows'}, with the time
+            taken to handle each replayed record, including the reflows and
+            draws it caused, and the number of reflows. The bounds are first
+            restored to those at the start of the recording, untimed.
+        """
+        self.restore()
+        counter = _ReflowCounter()
+        reflow_start_xchg = get_exchange('SD_reflow_start')
+        reflow_start_xchg.attach(counter)
+        results = []
+        t_start = time.time()
+        try:
+            for record in replayable(self.records):
+                if realtime:
+                    wait = record['t']/speed - (time.time() - t_start)
+                    if wait > 0:
+                        time.sleep(wait)
+                reflows = counter.count
+                t0 = time.time()
+                self.apply(record)
+                results.append({'t':record['t'], 'exchange':record['exchange'],
+                                'seconds':time.time() - t0, 'reflows':counter.count - reflows})
+        finally:
+            reflow_start_xchg.detach(counter)
+        return results
+
+
+def recorded_latencies(records):
+    """ Like the results of InteractionReplayer.replay, for the recorded
+        session: the seconds from each replayable record to the last
+        SD_reflow_done before the next replayable record, or 0.0 if there is
+        none. Requires that SD_reflow_done was recorded.
+    """
+    results = []
+    replayed = set(id(record) for record in replayable(records))
+    for record in records:
+        name = record['exchange']
+        if id(record) in replayed:
+            results.append({'t':record['t'], 'exchange':name, 'seconds':0.0, 'reflows':0})
+        elif (name == 'SD_reflow_done') and results:
+            results[-1]['seconds'] = record['t'] - results[-1]['t']
+            results[-1]['reflows'] += 1
+    return results
+
+
+def summarize(results):
+    """ {exchange:{'count', 'reflows', 'total', 'mean', 'median', 'max'}} of
+        the seconds in results from InteractionReplayer.replay or
+        recorded_latencies.
+    """
+    summary = {}
+    for name in sorted(set(result['exchange'] for result in results)):
+        seconds = np.array([result['seconds'] for result in results if result['exchange'] == name])
+        summary[name] = {'count':len(seconds),
+                         'reflows':sum(result['reflows'] for result in results
+                                       if result['exchange'] == name),
+                         'total':float(seconds.sum()), 'mean':float(seconds.mean()),
+                         'median':float(np.median(seconds)), 'max':float(seconds.max())}
+    return summary
@@ -0,0 +1,43 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+from stormdrain.bounds import Bounds
+from stormdrain.selection import Selection
+from stormdrain.support.matplotlib.artistupdaters import ScatterArtistOutlet
+
+
+def test_outlet_survives_slice_then_index_selections():
+    n = 10
+    data = np.zeros(n, dtype=[('x', float), ('y', float)])
+    data['x'] = np.arange(n)
+    fig, ax = plt.subplots()
+    art = ax.scatter([0], [0])
+    outlet = ScatterArtistOutlet(art)
+    update = outlet.update()
+    s = Selection(data, version=1)
+    mask_with_gap = np.ones(n, dtype=bool)
+    mask_with_gap[3] = False
+    for sel in (s.select(mask_with_gap), s.select(np.ones(n, dtype=bool)),
+                s.select(mask_with_gap)):
+        update.send(sel)
+        assert len(art.get_offsets()) == len(sel)
+    plt.close(fig)
+
+
+def test_outlet_with_depends_on_redraws_other_records_in_the_same_bounds():
+    n = 10
+    data = np.zeros(n, dtype=[('x', float), ('y', float)])
+    data['x'] = np.arange(n)
+    fig, ax = plt.subplots()
+    art = ax.scatter([0], [0])
+    outlet = ScatterArtistOutlet(art, bounds=Bounds(x=(0, 9)), depends_on=('x',))
+    update = outlet.update()
+    s = Selection(data, version=1)
+    lasso = np.arange(n) < 4
+    # The whole view, then a lasso within the same bounds, then the same lasso again
+    for sel in (s.select(np.ones(n, dtype=bool)), s.select(lasso), s.select(lasso)):
+        update.send(sel)
+        assert len(art.get_offsets()) == len(sel)
+    plt.close(fig)
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from stormdrain import kernels
+
+pytest.importorskip('numba')
+
+
+@pytest.mark.parametrize('dtypes', [('<f8', '<f8', '<f8'), ('>f4', '>f4', '>f4'),
+                                    ('<i8', '<f8', '>f4')])
+def test_range_mask_jit_matches_numpy(dtypes):
+    n = 1000
+    rng = np.random.RandomState(0)
+    a = np.zeros(n, dtype=[(name, dt) for name, dt in zip('abc', dtypes)])
+    for name in 'abc':
+        a[name] = rng.rand(n) * (100 if a[name].dtype.kind == 'i' else 1)
+        if a[name].dtype.kind == 'f':
+            a[name][::7] = np.nan
+    predicates = [('a', 0.1, 90), ('b', 0.2, None), ('c', None, 0.7)]
+    expected = kernels.range_mask(a, predicates, jit=False)
+    assert 0 < expected.sum() < n
+    assert np.array_equal(kernels.range_mask(a, predicates, jit=True), expected)
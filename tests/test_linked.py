@@ -0,0 +1,86 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+from stormdrain.bounds import BoundsFilter
+from stormdrain.data import NamedArrayDataset
+from stormdrain.pipeline import coroutine, Branchpoint
+from stormdrain.pubsub import get_exchange
+from stormdrain.support.matplotlib.linked import LinkedPanels, ViewHistory
+
+
+class _Counter(object):
+    def __init__(self):
+        self.count = 0
+
+    def send(self, msg):
+        self.count += 1
+
+
+@coroutine
+def counting(counter, target):
+    while True:
+        a = (yield)
+        counter.count += 1
+        target.send(a)
+
+
+@coroutine
+def keep_last(received):
+    while True:
+        received.append(len((yield)))
+
+
+def test_replayed_view_is_not_filtered_or_projected_again():
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    panels = LinkedPanels({ax:('x', 'y')})
+    data = np.zeros(100, dtype=[('x', float), ('y', float)])
+    data['x'] = np.arange(100)
+    data['y'] = np.arange(100)
+    filtered, projected, uncovered = _Counter(), _Counter(), _Counter()
+    received = []
+    outlet = Branchpoint([keep_last(received)])
+    projection = counting(projected, outlet.broadcast())
+    bounds_filter = BoundsFilter(bounds=panels.bounds, target=counting(filtered, projection))
+    d = NamedArrayDataset(data, target=bounds_filter.filter(), selections=True)
+    panels.history = ViewHistory(panels.bounds, datasets=[d])
+    panels.history.wrap(outlet)
+    panels.history.reflow_on_replay(uncovered)
+    reflow_start = _Counter()
+    get_exchange('SD_reflow_start').attach(reflow_start)
+    try:
+        panels.set_limits(x=(0, 9), y=(0, 99))
+        panels.set_limits(x=(0, 49), y=(0, 99))
+        assert (filtered.count, projected.count, reflow_start.count) == (2, 2, 2)
+        panels.set_limits(x=(0, 9), y=(0, 99))
+        assert (filtered.count, projected.count, reflow_start.count) == (2, 2, 2)
+        assert received == [10, 50, 10]
+        assert uncovered.count == 1
+    finally:
+        get_exchange('SD_reflow_start').detach(reflow_start)
+        get_exchange('SD_replay_reflow_start').detach(uncovered)
+        get_exchange('SD_reflow_start').detach(d)
+        plt.close(fig)
+
+
+def test_failed_transaction_does_not_reflow():
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    panels = LinkedPanels({ax:('x', 'y')})
+    reflow_start = _Counter()
+    get_exchange('SD_reflow_start').attach(reflow_start)
+    try:
+        try:
+            with panels.transaction():
+                panels.set_limits(x=(0, 1))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert reflow_start.count == 0
+        panels.set_limits(y=(0, 1))
+        assert reflow_start.count == 1
+    finally:
+        get_exchange('SD_reflow_start').detach(reflow_start)
+        plt.close(fig)
@@ -0,0 +1,58 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from stormdrain.support.matplotlib.linked import LinkedPanels
+
+
+class FakeTimer(object):
+    """ Stands in for a backend timer, which fires only when told to """
+    def __init__(self):
+        self.callbacks = []
+        self.running = False
+        self.single_shot = False
+
+    def add_callback(self, func, *args, **kwargs):
+        self.callbacks.append((func, args, kwargs))
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def fire(self):
+        if self.running:
+            self.running = False
+            for func, args, kwargs in self.callbacks:
+                func(*args, **kwargs)
+
+
+def test_returning_to_limits_after_they_were_set_elsewhere():
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    timers = []
+    def new_timer(*args, **kwargs):
+        timers.append(FakeTimer())
+        return timers[-1]
+    fig.canvas.new_timer = new_timer
+    panels = LinkedPanels({ax:('x', 'y')}, debounce_ms=10)
+    panels.set_limits(x=(0, 1), y=(0, 1))
+    timer, = timers
+    try:
+        # The user zooms to view A
+        ax.set_xlim(0, 0.5)
+        ax.set_ylim(0, 0.5)
+        timer.fire()
+        assert panels.bounds.x == (0, 0.5)
+        # A script sets view B
+        panels.set_limits(x=(0.5, 1), y=(0.5, 1))
+        assert ax.get_xlim() == (0.5, 1)
+        # The user goes back to view A
+        ax.set_xlim(0, 0.5)
+        ax.set_ylim(0, 0.5)
+        timer.fire()
+        assert panels.bounds.x == (0, 0.5)
+        assert panels.bounds.y == (0, 0.5)
+    finally:
+        plt.close(fig)
@@ -0,0 +1,31 @@
+import numpy as np
+
+from stormdrain.bounds import Bounds, BoundsFilter
+from stormdrain.pipeline import coroutine, register, Branchpoint, MaskFilter
+from stormdrain.support.matplotlib.poly_lasso import LassoFilter
+
+
+@coroutine
+def collect(received):
+    while True:
+        received.append((yield))
+
+
+def test_find_reaches_fused_filters():
+    received = []
+    pipe = register([(BoundsFilter, 'filter', {'bounds':Bounds(x=(0, 5))}),
+                     (LassoFilter, 'filter', {'coord_names':('x', 'y'),
+                                              'verts':[(-1, -1), (10, -1), (10, 10), (-1, 10)]}),
+                     (Branchpoint, 'broadcast', {}),
+                    ], target=collect(received))
+    assert isinstance(pipe.find(MaskFilter), MaskFilter)
+    assert isinstance(pipe.find(BoundsFilter), BoundsFilter)
+    lasso = pipe.find(LassoFilter)
+    assert isinstance(lasso, LassoFilter)
+
+    a = np.zeros(10, dtype=[('x', float), ('y', float)])
+    a['x'] = np.arange(10)
+    a['y'] = np.arange(10)
+    lasso.verts = [(-1, -1), (2.5, -1), (2.5, 10), (-1, 10)]
+    pipe.inlet.send(a)
+    assert list(np.asarray(received[-1])['x']) == [0, 1, 2]
@@ -0,0 +1,116 @@
+import gc
+
+import pytest
+
+from stormdrain.pubsub import (Exchange, get_exchange, NO_CHANGE,
+                               PRIORITY_DATA, PRIORITY_STYLE, PRIORITY_DRAW)
+
+
+class Task(object):
+    def __init__(self, name, log, result=None):
+        self.name = name
+        self.log = log
+        self.result = result
+
+    def send(self, msg):
+        self.log.append((self.name, msg))
+        return self.result
+
+
+def names(log):
+    return [name for name, msg in log]
+
+
+def test_priority_and_after_give_topological_order():
+    log = []
+    x = Exchange('test')
+    draw = Task('draw', log)
+    style = Task('style', log)
+    data = Task('data', log)
+    late_data = Task('late_data', log)
+    x.attach(draw, priority=PRIORITY_DRAW)
+    x.attach(style, priority=PRIORITY_STYLE, after=(late_data,))
+    x.attach(data, priority=PRIORITY_DATA)
+    # Attached last, with a priority that would put it after style, which follows it
+    x.attach(late_data, priority=PRIORITY_DRAW + 1)
+    x.send(1)
+    assert names(log) == ['data', 'draw', 'late_data', 'style']
+
+
+def test_after_cycle_is_refused():
+    log = []
+    x = Exchange('test')
+    a, b = Task('a', log), Task('b', log)
+    x.attach(a)
+    x.attach(b, after=(a,))
+    x.detach(a)
+    with pytest.raises(ValueError):
+        x.attach(a, after=(b,))
+
+
+def test_no_change_skips_followers():
+    log = []
+    x = Exchange('test')
+    data = Task('data', log, result=NO_CHANGE)
+    style = Task('style', log)
+    draw = Task('draw', log)
+    x.attach(data)
+    x.attach(style, after=(data,))
+    x.attach(draw, after=(style,))
+    assert x.send(1) is NO_CHANGE
+    assert names(log) == ['data']
+    data.result = None
+    assert x.send(2) is not NO_CHANGE
+    assert names(log) == ['data', 'data', 'style', 'draw']
+
+
+def test_dead_dependencies_are_not_unchanged():
+    log = []
+    x = Exchange('test')
+    unchanged = Task('unchanged', log, result=NO_CHANGE)
+    held = [Task('dead', log)]
+    follower = Task('follower', log)
+
+    class Killer(object):
+        def send(self, msg):
+            # The weak subscriber dies while the message is being sent
+            del held[:]
+            gc.collect()
+            return NO_CHANGE
+
+    killer = Killer()
+    x.attach(unchanged)
+    x.attach(killer)
+    x.attach(held[0], weak=True, after=(unchanged,))
+    x.attach(follower, after=(held[0],))
+    x.send(1)
+    assert names(log) == ['unchanged', 'follower']
+
+
+def test_nested_draws_are_deferred_and_sent_once():
+    log = []
+    outer = get_exchange('test_outer')
+    done = get_exchange('test_done')
+    draw = Task('draw', log)
+    style = Task('style', log)
+
+    class Sender(object):
+        def send(self, msg):
+            log.append(('sender', msg))
+            done.send('first')
+            done.send('second')
+
+    sender = Sender()
+    outer.attach(sender)
+    outer.attach(style, priority=PRIORITY_STYLE)
+    done.attach(draw, priority=PRIORITY_DRAW)
+    try:
+        outer.send(0)
+        assert log == [('sender', 0), ('style', 0), ('draw', 'second')]
+        del log[:]
+        done.send('direct')
+        assert log == [('draw', 'direct')]
+    finally:
+        outer.detach(sender)
+        outer.detach(style)
+        done.detach(draw)